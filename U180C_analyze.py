@@ -16,13 +16,59 @@ import os
 
 from append_csv_to_hdf5 import read_csv
 
-def read_data_file(csv_or_h5_filename):
+def fill_deadband(df, period=None, max_gap=None):
+    """ Forward-fill the values not recorded with a deadband, for the rows of a single meter only """
+    recorded = pd.Series(df.index, index=df.index)
+    if period:
+        df = df.resample(period).last()
+        recorded = recorded.resample(period).last()
+    df = df.ffill()
+    if max_gap:
+        stale = (df.index - pd.DatetimeIndex(recorded.ffill())) > pd.Timedelta(seconds=max_gap)
+        df[stale] = np.nan
+    return df
+
+def read_hdf_table(h5_filename, key='df'):
+    """ Read the table key of an HDF5 file, joining in the forward-filled <key>_deadband """
+    with pd.HDFStore(h5_filename, 'r') as store:
+        keys = store.keys()
+        df = store.select(key) if '/' + key in keys else None
+        if '/' + key + '_deadband' in keys:
+            sparse = store.select(key + '_deadband').ffill()
+            if df is None: return sparse
+            df = df.join(sparse.reindex(df.index, method='ffill'))
+    return df
+
+def read_data_file(csv_or_h5_filename, fill=False, period=None, max_gap=None, chunksize=None, key='df'):
+    """ Read a CSV log or the table key of an HDF5 file (an iterator of chunks with chunksize) """
+    if chunksize and (period or max_gap):
+        raise ValueError('period and max_gap cannot be used with chunksize.')
     lower_filename = csv_or_h5_filename.lower()
     if lower_filename.endswith('.csv'):
-        return read_csv(csv_or_h5_filename)
-    if lower_filename.endswith('.h5'):
-        return pd.read_hdf(csv_or_h5_filename, 'df')
+        df = read_csv(csv_or_h5_filename, chunksize)
+    elif lower_filename.endswith('.h5'):
+        if chunksize:
+            df = pd.read_hdf(csv_or_h5_filename, key, chunksize=chunksize)
+        else:
+            df = read_hdf_table(csv_or_h5_filename, key)
         #return read_hdf(csv_or_h5_filename, 'df', where = ['index>2'])
+    else:
+        return None
+    if chunksize:
+        return fill_chunks(df) if fill else iter(df)
+    if fill or period:
+        df = fill_deadband(df, period, max_gap)
+    return df
+
+def fill_chunks(chunks):
+    last = None
+    for df in chunks:
+        df = df.ffill()
+        if last is not None:
+            df = df.fillna(last)
+        if len(df):
+            last = df.iloc[-1]
+        yield df
 
 def main():
     import argparse
@@ -31,6 +77,8 @@ def main():
     parser.add_argument('input_file', help='The data file to read', nargs="?")
     parser.add_argument('output_file', help='The data file to write', nargs="?")
     parser.add_argument('--append', action='store_true', help='Append the data to the output file (if applicable)')
+    parser.add_argument('--fill', action='store_true', help='Forward-fill the values of data recorded with a deadband')
+    parser.add_argument('--grid', metavar='PERIOD', help="Forward-fill the data onto a regular grid, e.g. '5s'")
     parser.add_argument('--doc', action='store_true', help='Open the documentation in the Browser')
 
     args = parser.parse_args()
@@ -57,7 +105,7 @@ def main():
 
     if not args.input_file: parser.error('Please state an input file to read from.')
 
-    df = read_data_file(args.input_file)
+    df = read_data_file(args.input_file, fill=args.fill, period=args.grid)
     print("Finished reading the data file in.")
 
     if args.output_file:
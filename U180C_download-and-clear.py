@@ -13,13 +13,20 @@ def main():
     parser.add_argument('--username', default='admin', help='The HTTP username (if needed)')
     parser.add_argument('--password', default='admin', help='The HTTP password (if needed)')
     parser.add_argument('--download', action='store_true', help='Download the logfile.')
+    parser.add_argument('--incremental', action='store_true', help='Download only the new part of the logfile and append it to the archive <serial>.csv (in --archive-dir).')
+    parser.add_argument('--archive-dir', default='.', help='The folder of the archives for --incremental [Default: current folder].')
+    parser.add_argument('--hdf5', metavar='FILE', help='Append the logfile directly to this HDF5 file (like append_csv_to_hdf5.py) while downloading it, instead of saving it as CSV file.')
+    parser.add_argument('--batch-rows', type=int, default=10000, help='With --hdf5, append the rows in batches of this size [Default: 10000].')
     parser.add_argument('--clear', action='store_true', help='Clear the logfile.')
     parser.add_argument('--enable', action='store_true', help='Enable logging.')
     parser.add_argument('--disable', action='store_true', help='Disable logging.')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the on-disk cache of the device metadata (serial number).')
     args = parser.parse_args()
+    if args.hdf5 and args.incremental:
+        parser.error('Please choose either --hdf5 or --incremental.')
 
     try:
-        u180c = U180CWeb(args.host)
+        u180c = U180CWeb(args.host, cache=None if args.no_cache else DeviceCache())
     except U180CException as e:
         parser.error('Could not connect to host ' + args.host + '\n' + str(e))
 
@@ -27,12 +34,26 @@ def main():
         if not u180c.authenticate(args.username, args.password):
             parser.error('Wrong username/password (Or, you need to logout the user in your Browser).')
 
-        if args.download:
+        if args.download and args.hdf5:
+            import pandas as pd
+            from append_csv_to_hdf5 import append_stream
+            print('Appending the logfile to the HDF5 file {}'.format(args.hdf5))
+            store = pd.HDFStore(args.hdf5)
+            try:
+                for received, rows in append_stream(store, u180c.stream_csv(), u180c.csv_url(), u180c.csv_filename(), args.batch_rows):
+                    print('  {:4.1f} MiB downloaded, {} rows'.format(received/1024.**2, rows), end='\r')
+            finally:
+                store.close()
+            print()
+        elif args.download:
             first_yield = True
-            for status in u180c.download_csv():
+            for status in u180c.download_csv(args.incremental, args.archive_dir):
                 if first_yield:
                     first_yield = False
-                    print('Saving CSV file as {}'.format(status))
+                    if args.incremental:
+                        print('Appending the new rows to the CSV file {}'.format(status))
+                    else:
+                        print('Saving CSV file as {}'.format(status))
                     status = 0
                 print('  {:4.1f} MiB downloaded'.format(status/1024.**2), end='\r')
         if args.clear:
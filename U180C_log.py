@@ -5,42 +5,638 @@ import argparse
 from datetime import datetime as dt
 import time
 
+import os
+import math
+import stat
+import errno
+import socket
+import json
+import bisect
+import threading
+import socketserver
+import http.server
+import urllib.parse
+from array import array
+from collections import deque
+
 from u180c import *
 
+class Scheduler(object):
+    """ Deadline scheduler yielding the strictly increasing wall-clock timestamps of the poll cycles """
+
+    def __init__(self, period, align=True):
+        self.period = period
+        self.align = align
+        self.cycles = 0
+        self.missed = 0
+        self.latency = None
+        self.max_latency = 0.
+        self.total_latency = 0.
+        self.resyncs = 0
+
+    def anchor(self):
+        """ Wall-clock and monotonic time of the first tick from now on """
+        start_wall, start_mono = time.time(), time.monotonic()
+        if self.align:
+            offset = -start_wall % self.period
+            start_wall, start_mono = start_wall + offset, start_mono + offset
+        return start_wall, start_mono
+
+    def __iter__(self):
+        period = self.period
+        start_wall, start_mono = self.anchor()
+        clock_offset = start_wall - start_mono
+        last = None
+        n = 0
+        while True:
+            deadline = start_mono + n * period
+            delay = deadline - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            step = (time.time() - time.monotonic()) - clock_offset
+            if step > period / 4:
+                # re-anchor if the wall clock was stepped forward (e.g. by NTP after a boot without RTC)
+                logging.info('wall clock stepped by {:.3f} s, re-anchoring the ticks'.format(step))
+                self.resyncs += 1
+                start_wall, start_mono = self.anchor()
+                clock_offset = start_wall - start_mono
+                while last is not None and start_wall <= last:
+                    start_wall, start_mono = start_wall + period, start_mono + period
+                n = 0
+                continue
+            if step < -period / 4:
+                # the ticks never go back (the consumers rely on increasing timestamps)
+                logging.warning('wall clock stepped back by {:.3f} s, keeping the ticks increasing'.format(-step))
+                clock_offset += step
+            last = start_wall + n * period
+            yield last
+            # the cycle is done, record its latency (relative to the deadline)
+            self.latency = time.monotonic() - deadline
+            self.cycles += 1
+            self.total_latency += self.latency
+            self.max_latency = max(self.max_latency, self.latency)
+            logging.debug('cycle {} took {:.3f} s'.format(self.cycles, self.latency))
+            n += 1
+            late = time.monotonic() - (start_mono + n * period)
+            if late > period / 2:
+                skip = int(late / period + 0.5)
+                self.missed += skip
+                n += skip
+                logging.debug('missed {} tick(s)'.format(skip))
+
+    def summary(self):
+        if not self.cycles: return 'No cycles run.'
+        return '{} cycles, {} missed ticks, {} clock re-anchorings, latency: mean {:.3f} s, max {:.3f} s'.format(
+            self.cycles, self.missed, self.resyncs, self.total_latency / self.cycles, self.max_latency)
+
+class BufferedLineWriter(object):
+    """ Group commit: writes the lines every batch_rows lines or batch_seconds seconds """
+
+    def __init__(self, stream, batch_rows=100, batch_seconds=60., fsync=False):
+        self.stream = stream
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.fsync = fsync
+        self.lines = []
+        self.last_flush = time.monotonic()
+
+    def write_line(self, line):
+        self.lines.append(line + '\n')
+        if len(self.lines) >= self.batch_rows or time.monotonic() - self.last_flush >= self.batch_seconds:
+            self.flush()
+
+    def poll(self):
+        """ Flush the lines buffered for batch_seconds, also if no new line arrives (call it regularly) """
+        if self.lines and time.monotonic() - self.last_flush >= self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.lines: return
+        self.stream.write(''.join(self.lines))
+        self.lines = []
+        self.stream.flush()
+        if self.fsync:
+            os.fsync(self.stream.fileno())
+
+def open_log_file(filename):
+    """ Open a log file for appending with a torn last line cut off, returns the file and whether it is empty """
+    with open(filename, 'ab+') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 1))
+        if size and f.read(1) != b'\n':
+            # look for the end of the last complete line, block by block
+            cut = size
+            while cut:
+                start = max(0, cut - 65536)
+                f.seek(start)
+                newline = f.read(cut - start).rfind(b'\n')
+                cut = start
+                if newline >= 0:
+                    cut += newline + 1
+                    break
+            else:
+                raise ValueError('{} has no complete line, it does not look like a log file.'.format(filename))
+            sys.stderr.write('Removing a torn last line from {}.\n'.format(filename))
+            f.truncate(cut)
+            size = cut
+    return open(filename, 'a'), size == 0
+
+class TextWriter(object):
+    """ Writes the readings as lines of text in the 'plain' or 'csv' style """
+
+    def __init__(self, style, measures, fleet=False, period=5., stream=None, batch_rows=1, batch_seconds=60., fsync=False, header=True):
+        self.stream = stream or sys.stdout
+        self.out = BufferedLineWriter(self.stream, batch_rows, batch_seconds, fsync)
+        self.fleet = fleet
+        self.write_header = header
+        if style == 'csv':
+            self.sep = ';'
+            self.headers = ["Date", "Time"] + [m['csv_code'] for m in measures]
+            self.date_format = ['%d/%m/%Y', '%H:%M:%S']
+        elif style == 'plain':
+            self.sep = ' '
+            self.headers = ["Date&Time"] + [m['code'] for m in measures]
+            self.date_format = ['%Y-%m-%dT%H:%M:%S']
+        if period < 1.:
+            # sub-second logging needs fractional seconds in the timestamps
+            self.date_format[-1] += '.%f'
+        if fleet:
+            self.headers = ["SN"] + self.headers
+
+    def header(self):
+        return self.sep.join(self.headers)
+
+    def format(self, serial, tick, values):
+        sep = self.sep
+        line = ""
+        if self.fleet: line += serial + sep
+        line += sep.join([dt.fromtimestamp(tick).strftime(df) for df in self.date_format])
+        line += sep
+        line += sep.join(['{:.3f}'.format(val) for val in values])
+        return line
+
+    def open(self):
+        if self.write_header:
+            self.out.write_line(self.header())
+            self.out.flush()
+
+    def write(self, serial, tick, values):
+        self.out.write_line(self.format(serial, tick, values))
+
+    def poll(self):
+        self.out.poll()
+
+    def close(self):
+        self.out.flush()
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+class SegmentedTextWriter(TextWriter):
+    """ Writes the text output to daily segment files, renamed from .part when they are closed """
+
+    PART = SEGMENT_PART
+
+    def __init__(self, directory, prefix, style, measures, fleet=False, period=5., batch_rows=100, batch_seconds=60., max_bytes=None):
+        TextWriter.__init__(self, style, measures, fleet, period, None, batch_rows, batch_seconds, fsync=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.ext = '.csv' if style == 'csv' else '.txt'
+        self.max_bytes = max_bytes
+        self.stream = None
+        self.day = None
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, day, number):
+        name = '{}_{}{}'.format(self.prefix, day, '_{:03d}'.format(number) if number else '')
+        return os.path.join(self.directory, name + self.ext)
+
+    def open(self):
+        # close the segments left open by an earlier (crashed) run
+        for name in os.listdir(self.directory):
+            if name.startswith(self.prefix + '_') and name.endswith(self.ext + self.PART):
+                path = os.path.join(self.directory, name)
+                try:
+                    stream, empty = open_log_file(path)
+                except ValueError as e:
+                    sys.stderr.write("{} - couldn't close the segment {}. Error: {}\n".format(dt.now(), path, e))
+                    continue
+                stream.close()
+                if empty:
+                    os.remove(path)
+                else:
+                    os.rename(path, path[:-len(self.PART)])
+
+    def open_segment(self, day):
+        self.close_segment()
+        number = 0
+        while os.path.exists(self.segment_path(day, number)):
+            number += 1
+        self.day, self.path = day, self.segment_path(day, number) + self.PART
+        self.stream, empty = open_log_file(self.path)
+        self.out.stream = self.stream
+        self.written = self.stream.tell()
+        if empty:
+            self.out.write_line(self.header())
+
+    def close_segment(self):
+        if self.stream is None: return
+        self.out.flush()
+        self.stream.close()
+        self.stream = None
+        os.rename(self.path, self.path[:-len(self.PART)])
+
+    def write(self, serial, tick, values):
+        day = dt.fromtimestamp(tick).strftime('%Y-%m-%d')
+        if day != self.day or (self.max_bytes and self.written >= self.max_bytes):
+            self.open_segment(day)
+        line = self.format(serial, tick, values)
+        self.written += len(line) + 1
+        self.out.write_line(line)
+
+    def close(self):
+        self.close_segment()
+
+class HDF5Writer(object):
+    """ Appends the readings as float32 rows to the table(s) of an HDF5 file in batches """
+
+    def __init__(self, filename, measures, fleet=False, batch_rows=100, deadband=None, batch_seconds=60.):
+        import pandas as pd
+        import numpy as np
+        self.pd, self.np = pd, np
+        self.filename = filename
+        self.fleet = fleet
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.deadband = deadband
+        columns = [m['csv_code'].replace(' ', '') for m in measures]
+        if deadband:
+            self.columns = [columns[i] for i in deadband.dense]
+            self.deadband_columns = [columns[i] for i in deadband.sparse]
+        else:
+            self.columns = columns
+        self.rows = dict()
+        # when the oldest row buffered per table was added
+        self.first_row = dict()
+
+    def open(self):
+        self.store = self.pd.HDFStore(self.filename)
+
+    def write(self, serial, tick, values):
+        key = 'df_' + serial if self.fleet else 'df'
+        if self.deadband:
+            sparse = self.deadband.filter(tick, values, serial)
+            if sparse is not None:
+                self.append(key + '_deadband', tick, sparse)
+            if not self.columns: return
+            values = [values[i] for i in self.deadband.dense]
+        self.append(key, tick, values)
+
+    def append(self, key, tick, values):
+        if key not in self.rows:
+            self.first_row[key] = time.monotonic()
+        ticks, rows = self.rows.setdefault(key, ([], array('f')))
+        rows.fromlist(list(values))
+        ticks.append(tick)
+        if len(ticks) >= self.batch_rows:
+            self.flush(key)
+
+    def poll(self):
+        """ Append the rows buffered for batch_seconds (call it regularly) """
+        now = time.monotonic()
+        for key in [key for key in self.rows if now - self.first_row[key] >= self.batch_seconds]:
+            self.flush(key)
+
+    def flush(self, key):
+        ticks, rows = self.rows.pop(key)
+        pd, np = self.pd, self.np
+        sparse = key.endswith('_deadband')
+        columns = self.deadband_columns if sparse else self.columns
+        values = np.frombuffer(rows, dtype=np.float32).reshape(len(ticks), len(columns))
+        index = pd.DatetimeIndex([dt.fromtimestamp(tick) for tick in ticks], name='Date_Time')
+        df = pd.DataFrame(values, index=index, columns=columns)
+        if sparse:
+            # mostly NaN, compresses well
+            self.store.append(key, df, format='t', complib='zlib', complevel=5)
+        else:
+            self.store.append(key, df, format='t', complib=None)
+        self.store.flush()
+
+    def close(self):
+        for key in list(self.rows):
+            self.flush(key)
+        self.store.close()
+
+class RollingStats(object):
+    """ Mean, min, max and std of the finite values of some columns over a sliding time window """
+
+    def __init__(self, window, num_columns):
+        self.window = window
+        self.num_columns = num_columns
+        self.samples = deque()
+        self.counts = [0] * num_columns
+        self.mean = [0.] * num_columns
+        self.m2 = [0.] * num_columns
+        self.mins = [deque() for i in range(num_columns)]
+        self.maxs = [deque() for i in range(num_columns)]
+
+    def update(self, tick, values):
+        """ Add a sample and return [mean, min, max, std] for every column """
+        counts, mean, m2 = self.counts, self.mean, self.m2
+        self.samples.append((tick, values))
+        for i, x in enumerate(values):
+            if not math.isfinite(x): continue
+            counts[i] += 1
+            d = x - mean[i]
+            mean[i] += d / counts[i]
+            m2[i] += d * (x - mean[i])
+            mins, maxs = self.mins[i], self.maxs[i]
+            while mins and mins[-1][1] >= x: mins.pop()
+            mins.append((tick, x))
+            while maxs and maxs[-1][1] <= x: maxs.pop()
+            maxs.append((tick, x))
+        cutoff = tick - self.window
+        while self.samples[0][0] <= cutoff:
+            old_tick, old_values = self.samples.popleft()
+            for i, x in enumerate(old_values):
+                if not math.isfinite(x): continue
+                counts[i] -= 1
+                if not counts[i]:
+                    mean[i], m2[i] = 0., 0.
+                    continue
+                d = x - mean[i]
+                mean[i] -= d / counts[i]
+                m2[i] = max(0., m2[i] - d * (x - mean[i]))
+        for extrema in self.mins + self.maxs:
+            while extrema and extrema[0][0] <= cutoff: extrema.popleft()
+        nan = float('nan')
+        results = []
+        for i in range(self.num_columns):
+            n = counts[i]
+            if not n:
+                results += [nan, nan, nan, nan]
+                continue
+            std = (m2[i] / (n - 1)) ** 0.5 if n > 1 else nan
+            results += [mean[i], self.mins[i][0][1], self.maxs[i][0][1], std]
+        return results
+
+class StatsColumns(object):
+    """ Appends the rolling statistics of stats_measures over each of the windows (per meter) to the readings """
+
+    STATS = ('mean', 'min', 'max', 'std')
+
+    def __init__(self, measures, stats_measures, windows):
+        self.indices = [measures.index(m) for m in stats_measures]
+        self.windows = windows
+        self.columns = []
+        for window in windows:
+            for m in stats_measures:
+                for name in self.STATS:
+                    suffix = '_{}_{:g}s'.format(name, window)
+                    self.columns.append({'code': m['code'] + suffix, 'csv_code': m['csv_code'] + suffix})
+        self.stats = dict()
+
+    def extend(self, serial, tick, values):
+        if serial not in self.stats:
+            self.stats[serial] = [RollingStats(window, len(self.indices)) for window in self.windows]
+        selected = [values[i] for i in self.indices]
+        extended = array('d', values)
+        for stats in self.stats[serial]:
+            extended.extend(stats.update(tick, selected))
+        return extended
+
+class RingBuffer(object):
+    """ Fixed-size buffer of the most recent readings of one meter in two flat arrays """
+
+    def __init__(self, capacity, num_columns):
+        self.capacity = capacity
+        self.num_columns = num_columns
+        self.timestamps = array('d', [0.]) * capacity
+        self.values = array('d', [0.]) * (capacity * num_columns)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __getitem__(self, i):
+        """ The timestamp of the i-th oldest row (makes the buffer usable with bisect) """
+        return self.timestamps[(self.count - len(self) + i) % self.capacity]
+
+    def append(self, tick, values):
+        n = self.num_columns
+        with self.lock:
+            i = self.count % self.capacity
+            self.timestamps[i] = tick
+            self.values[i*n:(i+1)*n] = values
+            self.count += 1
+
+    def range(self, start=None, end=None):
+        """ Copies of the (timestamps, values) of the rows with start <= timestamp <= end """
+        n = self.num_columns
+        with self.lock:
+            first = bisect.bisect_left(self, start) if start is not None else 0
+            last = bisect.bisect_right(self, end) if end is not None else len(self)
+            timestamps, values = array('d'), array('d')
+            offset = self.count - len(self)
+            for lo, hi in self.slices(offset + first, offset + max(first, last)):
+                timestamps.extend(self.timestamps[lo:hi])
+                values.extend(self.values[lo*n:hi*n])
+        return timestamps, values
+
+    def slices(self, begin, end):
+        """ The physical index ranges of the logical rows begin to end (at most two) """
+        lo, hi = begin % self.capacity, (end - 1) % self.capacity + 1
+        if begin == end: return []
+        if lo < hi: return [(lo, hi)]
+        return [(lo, self.capacity), (0, hi)]
+
+class LiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves GET /meta (JSON) and GET /data (float64 timestamps, then values, see the X-Rows and X-Columns headers) """
+
+    def do_GET(self):
+        server = self.server.live
+        url = urllib.parse.urlsplit(self.path)
+        query = dict((k, v[-1]) for k, v in urllib.parse.parse_qs(url.query).items())
+        try:
+            if url.path in ('/', '/meta'):
+                body = json.dumps(server.meta()).encode('utf-8')
+                headers = {'Content-Type': 'application/json'}
+            elif url.path == '/data':
+                start, end = [float(query[key]) if key in query else None for key in ('start', 'end')]
+                if 'last' in query:
+                    start = time.time() - float(query['last'])
+                measures = query['measures'].split(',') if 'measures' in query else None
+                columns, timestamps, values = server.query(query.get('serial'), start, end, measures)
+                body = timestamps.tobytes() + values.tobytes()
+                headers = {'Content-Type': 'application/octet-stream',
+                           'X-Rows': str(len(timestamps)),
+                           'X-Columns': ','.join(columns),
+                           'X-Byte-Order': sys.byteorder}
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        headers['Content-Length'] = str(len(body))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # there is no client address on a Unix socket
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug('live server: ' + format % args)
+
+class LiveServer(object):
+    """ Keeps the recent readings in ring buffers and serves them over HTTP on a port, host:port or Unix socket path """
+
+    def __init__(self, address, measures, seconds, period):
+        self.columns = [m['code'] for m in measures]
+        self.capacity = int(seconds / period) + 1
+        self.period = period
+        self.buffers = dict()
+        # guards self.buffers, the request threads read it while write() adds meters
+        self.lock = threading.Lock()
+        if os.sep in address:
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise ValueError('{} exists and is not a socket.'.format(address))
+                # only replace a stale socket, not the one of a running logger
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(address)
+                except OSError as e:
+                    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT): raise
+                    if os.path.exists(address): os.remove(address)
+                else:
+                    raise ValueError('{} is in use by another server.'.format(address))
+                finally:
+                    probe.close()
+            server_class = type('LiveServer', (socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {'daemon_threads': True})
+            self.httpd = server_class(address, LiveRequestHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            server_class = type('LiveServer', (socketserver.ThreadingMixIn, http.server.HTTPServer), {'daemon_threads': True})
+            self.httpd = server_class((host or 'localhost', int(port)), LiveRequestHandler)
+        self.address = address
+        self.httpd.live = self
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='live-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, serial, tick, values):
+        buffer = self.buffers.get(serial)
+        if buffer is None:
+            with self.lock:
+                buffer = self.buffers[serial] = RingBuffer(self.capacity, len(self.columns))
+        buffer.append(tick, values)
+
+    def meta(self):
+        with self.lock:
+            serials = sorted(self.buffers)
+        return {'serials': serials, 'columns': self.columns,
+                'capacity': self.capacity, 'period': self.period}
+
+    def query(self, serial, start=None, end=None, measures=None):
+        with self.lock:
+            buffers = dict(self.buffers)
+        if serial is None:
+            if len(buffers) != 1:
+                raise ValueError('Please state the serial number of the meter.')
+            serial = next(iter(buffers))
+        timestamps, values = buffers[serial].range(start, end)
+        if measures is None:
+            return self.columns, timestamps, values
+        n = len(self.columns)
+        unknown = [measure for measure in measures if measure not in self.columns]
+        if unknown:
+            raise ValueError('Measures not logged: ' + ', '.join(unknown))
+        cols = [self.columns.index(measure) for measure in measures]
+        values = array('d', [values[row*n + col] for row in range(len(timestamps)) for col in cols])
+        return measures, timestamps, values
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if os.sep in self.address and os.path.exists(self.address):
+            os.remove(self.address)
+
 def main():
     parser = argparse.ArgumentParser(description='Talk to a Gossen U180C via Modbus TCP or HTTP')
-    parser.add_argument('host', help="The U180C LAN Interface to connect to. State its IP address for MODBUS TCP or 'http://ip-or-host' for HTTP.")
+    parser.add_argument('host', help="The U180C LAN Interface to connect to. State its IP address for MODBUS TCP or 'http://ip-or-host' for HTTP. "
+                                     "Separate multiple hosts by commas to log a fleet of meters (adds the serial number as first column).")
     parser.add_argument('measures', metavar='MEASURE', help='Measures to be logged. List all possible with --list.', nargs='*', default='all')
     parser.add_argument('--debug', action='store_true', help='Enable debugging output')
     parser.add_argument('--filter', help="Filter output values. State 1,2,3 for phases or 'sys' for system.")
     parser.add_argument('--list', action='store_true', help="List all possible measures.")
-    parser.add_argument('--style', choices=['csv', 'plain'], default='plain', help='The output style')
+    parser.add_argument('--style', choices=['csv', 'plain', 'hdf5'], default='plain', help='The output style (hdf5 appends float32 rows to the table of the --output file)')
+    parser.add_argument('--output', help='The file to write to [Default: stdout]. Required for --style hdf5.')
+    parser.add_argument('--segment-dir', help='Write the (text) output to daily segment files in this directory, see also --segment-size.')
+    parser.add_argument('--segment-size', type=float, help='Also start a new segment when the current one reaches this size in MiB.')
+    parser.add_argument('--batch-rows', type=int, default=100, help='Number of rows to collect before writing (and syncing) them to the output [Default: 100].')
+    parser.add_argument('--batch-seconds', type=float, default=60., help='Write the collected rows at least every that many seconds [Default: 60].')
     parser.add_argument('--username', default='admin', help='The HTTP username (if needed)')
     parser.add_argument('--password', default='admin', help='The HTTP password (if needed)')
-    parser.add_argument('--flush', action='store_true', help='Set this flag if you want the output to be flushed after each line.')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the on-disk cache of the device metadata (serial number etc.).')
+    parser.add_argument('--window', type=int, default=1, help='Number of Modbus TCP requests to keep in flight on one connection (pipelining) [Default: 1].')
+    parser.add_argument('--flush', action='store_true', help='Set this flag if you want the output to be flushed after each line (same as --batch-rows 1).')
+    parser.add_argument('--period', type=float, default=5., help='The logging period in seconds (sub-second values are fine) [Default: 5].')
+    parser.add_argument('--counter-interval', type=float, default=0., help='Read the (slowly changing) counters only every that many seconds and repeat their last values in between [Default: every period].')
+    parser.add_argument('--stats', metavar='MEASURES', help='Also log the rolling mean, min, max and std of these (comma separated) measures, e.g. P1,P2,P3,F.')
+    parser.add_argument('--stats-windows', default='60,300,900', help='The windows of the rolling statistics in seconds [Default: 60,300,900].')
+    parser.add_argument('--deadband', metavar='SPEC', help="Record a value only when it moved beyond its deadband (absolute or relative in %%), e.g. '*kWh*=0.01,F=0.02,V*=0.5%%'. With --style hdf5, these measures go to their own table. Otherwise they are written as nan when unchanged, and rows are skipped only if all logged measures have a deadband.")
+    parser.add_argument('--heartbeat', type=float, default=900., help='With --deadband, record a full row at least every that many seconds [Default: 900].')
+    parser.add_argument('--serve', metavar='ADDRESS', help="Serve the recent readings over HTTP on this port, 'host:port' or Unix socket path: "
+                                                           "GET /meta and /data?serial=SN&start=T&end=T&last=SECONDS&measures=a,b (all optional).")
+    parser.add_argument('--serve-seconds', type=float, default=600., help='Number of seconds of readings to keep in memory for --serve [Default: 600].')
+    parser.add_argument('--no-align', action='store_true', help='Do not align the logging ticks to multiples of the period on the wall clock.')
     args = parser.parse_args()
+    if args.style == 'hdf5' and not args.output:
+        parser.error('Please state an --output file for the hdf5 style.')
+    if args.segment_dir and (args.output or args.style == 'hdf5'):
+        parser.error('--segment-dir works with the text styles only and replaces --output.')
 
     if args.debug:
         logging.basicConfig()
         log = logging.getLogger()
         log.setLevel(logging.DEBUG)
 
+    hosts = args.host.split(',')
+    fleet = len(hosts) > 1
+    cache = None if args.no_cache else DeviceCache()
     try:
-        u180c = U180CFactory(args.host)
+        if fleet:
+            u180c = U180CFleet(hosts, cache=cache, window=args.window)
+        else:
+            u180c = U180CFactory(args.host, cache=cache, window=args.window)
     except U180CException as e:
         parser.error('Could not connect to host ' + args.host + '\n' + str(e))
 
     try:
-        if type(u180c) is U180CWeb:
+        if fleet or type(u180c) is U180CWeb:
             if not u180c.authenticate(args.username, args.password):
                 parser.error('Wrong username/password (Or, you need to logout the user in your Browser).')
 
-        coils = u180c.read_coils()
-        for coil_val in coils:
-            coil = coil_val[0]
-            value = coil_val[1]
-            if value:
-                sys.stderr.write("Warning: Coil {code} ({descr}) is ON!\n".format(**coil))
+        if fleet:
+            serials_coils = u180c.read_coils()
+        else:
+            serials_coils = [(u180c.serial, u180c.read_coils())]
+        for serial, coils in serials_coils:
+            if isinstance(coils, Exception):
+                sys.stderr.write("Warning: Could not read the coils of {}: {}\n".format(serial, coils))
+                continue
+            for coil_val in coils:
+                coil = coil_val[0]
+                value = coil_val[1]
+                if value:
+                    sys.stderr.write("Warning: Coil {code} ({descr}) of {serial} is ON!\n".format(serial=serial, **coil))
 
         #regs_values = u180c.counters_balance
         #for reg_value in regs_values:
@@ -67,18 +663,12 @@ def main():
         measure_lists = [REAL_TIME_LIST, COUNTER_LIST_TOTAL, COUNTER_LIST_TARIFF1, COUNTER_LIST_TARIFF2, PARTIAL_COUNTER_LIST, BALANCE_LIST]
         flat_measure_list = []
         list(map(flat_measure_list.extend, measure_lists))
-        if args.style == 'plain':
-            sep = ' '
-        elif args.style == 'csv':
-            sep = ';'
-
         if args.list:
             print("Possible measures:")
             for measure in flat_measure_list:
                 print(measure)
             sys.exit(0)
 
-        measures = []
         if args.measures == 'all':
             measures = [RR[key] for key in flat_measure_list]
         else:
@@ -88,51 +678,96 @@ def main():
                     measure = int(measure)
                 except:
                     pass
-                measure_found = False
-                for key in RR_LIST:
-                    reg_def = RR[key]
-                    if measure in (reg_def['api_no'], reg_def['code'], reg_def['csv_code']):
-                        measures.append(reg_def)
-                        measure_found = True
-                        break
-                if not measure_found:
-                    parser.error('Measure {} is unknown.'.format(measure))
-
-        date_format = []
-        headers = []
-        if args.style == 'csv':
-            headers = ["Date", "Time"] + [m['csv_code'] for m in measures]
-            date_format = ['%d/%m/%Y', '%H:%M:%S']
-        elif args.style == 'plain':
-            headers = ["Date&Time"] + [m['code'] for m in measures]
-            date_format = ['%Y-%m-%dT%H:%M:%S']
-        print(sep.join(headers))
+                try:
+                    measures.append(find_register(measure))
+                except U180CException as e:
+                    parser.error(str(e))
+        if args.counter_interval > args.period:
+            counter_list = [code for code in RR_LIST if code not in REAL_TIME_LIST]
+            plan = TieredReadPlan([m['code'] for m in measures], [(counter_list, args.counter_interval)])
+        else:
+            plan = ReadPlan([m['code'] for m in measures])
+
+        stats = None
+        columns = measures
+        if args.stats:
+            try:
+                stats_measures = [find_register(measure) for measure in args.stats.split(',')]
+                windows = [float(window) for window in args.stats_windows.split(',')]
+            except (U180CException, ValueError) as e:
+                parser.error(str(e))
+            if any(window <= 0 for window in windows):
+                parser.error('The --stats-windows must be longer than 0 seconds.')
+            for m in stats_measures:
+                if m not in measures:
+                    parser.error('The measure {} for --stats is not logged.'.format(m['code']))
+            stats = StatsColumns(measures, stats_measures, windows)
+            columns = measures + stats.columns
+        deadband = None
+        if args.deadband:
+            try:
+                deadband = Deadband(columns, args.deadband, args.heartbeat)
+            except U180CException as e:
+                parser.error(str(e))
+
+        if args.style == 'hdf5':
+            writer = HDF5Writer(args.output, columns, fleet, batch_rows=args.batch_rows, deadband=deadband, batch_seconds=args.batch_seconds)
+        elif args.segment_dir:
+            prefix = 'fleet' if fleet else u180c.serial
+            max_bytes = int(args.segment_size * 1024**2) if args.segment_size else None
+            batch_rows = 1 if args.flush else args.batch_rows
+            writer = SegmentedTextWriter(args.segment_dir, prefix, args.style, columns, fleet, args.period,
+                                         batch_rows, args.batch_seconds, max_bytes)
+        else:
+            if args.output:
+                try:
+                    stream, empty = open_log_file(args.output)
+                except (IOError, ValueError) as e:
+                    parser.error(str(e))
+            else:
+                stream, empty = sys.stdout, True
+            # interactive runs show every line at once
+            batch_rows = 1 if args.flush or stream.isatty() else args.batch_rows
+            writer = TextWriter(args.style, columns, fleet, args.period, stream, batch_rows, args.batch_seconds,
+                                fsync=bool(args.output), header=empty)
+        live = None
+        if args.serve:
+            try:
+                live = LiveServer(args.serve, columns, args.serve_seconds, args.period)
+            except (ValueError, OSError) as e:
+                parser.error('Cannot serve on {}: {}'.format(args.serve, e))
+        writer.open()
+        if live: live.start()
+        scheduler = Scheduler(args.period, align=not args.no_align)
         try:
-            while True:
-                readings = []
-                regs_values = u180c.all_measures
-                for measure in measures:
-                    for reg_value in regs_values:
-                        reg_def = reg_value[0]
-                        if measure == reg_def:
-                            readings.append(reg_value)
-                line = ""
-                line += sep.join([dt.now().strftime(df) for df in date_format])
-                line += sep
-                line += sep.join(['{:.3f}'.format(val) if type(val) == float else str(val) for rd, val in readings])
-                #for rd, val in readings:
-                #    if type(val) == float:
-                #        line += "{:.3f}".format(val)
-                #    else:
-                #        line += "{}".format(val)
-                #    line += sep
-                print(line)
-                if args.flush: sys.stdout.flush()
-                time.sleep(4.7)
+            for tick in scheduler:
+                if fleet:
+                    serials_readings = u180c.read_plan(plan, tick)
+                else:
+                    try:
+                        serials_readings = [(u180c.serial, u180c.read_plan(plan))]
+                    except U180CConnectionException as e:
+                        sys.stderr.write("{} - couldn't read from {}. Error: {}\n".format(dt.now(), u180c.host, e))
+                        serials_readings = []
+                for serial, reading in serials_readings:
+                    values = reading.values
+                    if stats: values = stats.extend(serial, tick, values)
+                    if live: live.write(serial, tick, values)
+                    if deadband and args.style != 'hdf5':
+                        # (the HDF5Writer stores the measures with a deadband in their own table)
+                        values = deadband.apply(tick, values, serial)
+                        if values is None: continue
+                    writer.write(serial, tick, values)
+                # bound the time rows stay buffered, also when nothing was written
+                writer.poll()
         except KeyboardInterrupt:
             sys.stderr.write('[Ctrl]-[c] pressed. Exiting...\n')
         except U180CException as e:
             sys.stderr.write('A problem occured: {}\n'.format(e))
+        finally:
+            writer.close()
+            if live: live.close()
+        sys.stderr.write(scheduler.summary() + '\n')
 
     finally:
         u180c.close()
@@ -4,39 +4,234 @@ import pandas as pd
 import numpy as np
 # Python Std Lib
 from itertools import product
+import itertools
+from collections import deque
 import glob
+import io
 import os
 import sys
+import time
 from datetime import datetime as dt
 
-def read_csv(filename):
-    df = pd.io.parsers.read_csv(filename, sep=';', parse_dates=[['Date', 'Time']], dayfirst=True)
-    df.set_index('Date_Time', inplace = True)
-    cols_to_drop = 'SN', 'ACTUAL_TARIFF_(EC)', 'PRI_S(EC)_VALUE_(EC)'
-    for col in cols_to_drop:
-        if col in df.columns: df.drop(col, axis=1, inplace = True)
-    if 'kWh SYS_exp' in df.columns:
-        df['kWhSYS_exp'] = df['kWh SYS_exp']
-        df.drop('kWh SYS_exp', axis=1, inplace = True)
+from u180c import Deadband, RR_BY_API_NO, RR_BY_CSV_CODE, SEGMENT_PART
+
+# The columns of the device log not stored and the renamed columns
+CSV_DROP_COLUMNS = ('SN', 'ACTUAL_TARIFF_(EC)', 'PRI_S(EC)_VALUE_(EC)')
+CSV_RENAME_COLUMNS = {'kWh SYS_exp': 'kWhSYS_exp'}
+# The dtypes of the columns by csv_code
+CSV_DTYPES = dict((rd.csv_code, np.float32) for rd in RR_BY_API_NO)
+CSV_DTYPES.update((CSV_RENAME_COLUMNS[code], np.float32) for code in CSV_RENAME_COLUMNS)
+CSV_DTYPES.update({'SN': str, 'Date': str, 'Time': str})
+
+def read_csv_header(filename):
+    """ The column names of a CSV log file (or buffer, which is rewound) """
+    if hasattr(filename, 'readline'):
+        pos = filename.tell()
+        header = filename.readline()
+        filename.seek(pos)
+    else:
+        with open(filename, 'rb') as f:
+            header = f.readline()
+    if isinstance(header, bytes): header = header.decode('latin-1')
+    return header.rstrip('\r\n').split(';')
+
+def read_csv(filename, chunksize=None, keep_serial=False):
+    """ Read a CSV log file (or with chunksize an iterator of chunks) into a DataFrame with the register dtypes """
+    names = [CSV_RENAME_COLUMNS.get(col, col) for col in read_csv_header(filename)]
+    usecols = [col for col in names if col not in CSV_DROP_COLUMNS or (keep_serial and col == 'SN')]
+    dtype = dict((col, CSV_DTYPES[col]) for col in usecols if col in CSV_DTYPES)
+    df = pd.read_csv(filename, sep=';', header=0, names=names, usecols=usecols, dtype=dtype, chunksize=chunksize)
+    if chunksize:
+        return (normalize_csv(chunk) for chunk in df)
+    return normalize_csv(df)
+
+def csv_date_format(time_field):
+    """ The strptime format of the Date and Time fields of a log file with this Time """
+    if '.' in time_field:
+        # sub-second logging (U180C_log.py --period < 1)
+        return '%d/%m/%Y %H:%M:%S.%f'
+    return '%d/%m/%Y %H:%M:%S'
+
+def normalize_csv(df):
+    date_format = csv_date_format(df['Time'].iloc[0] if len(df) else '')
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.pop('Date') + ' ' + df.pop('Time'), format=date_format), name='Date_Time')
     ## divide columns with kW / kVA / kvar by 1000 to get the unit right:
     #relevant_fragments = ['kW', 'kVA', 'kvar']
     #relevant_fragments += [''.join(p) for p in product(['P', 'S', 'Q'], ['1', '2', '3', 'SYS'])]
     #for col in df.columns:
     #    if any(x in col for x in relevant_fragments):
     #        df[col] = df[col]/1000.
-    # change all columns of type np.float64 to type np.float32:
+    # columns not in the schema (e.g. the rolling statistics of U180C_log.py --stats):
     for column in df.columns:
         if df[column].dtype == np.float64:
             df[column] = df[column].astype(np.float32)
     # Finished reading the data file in
     return df
 
+_deadbands = dict()
+
+def apply_deadband(df, spec, heartbeat=900., key=None):
+    """ Split df into the measures without a deadband (all rows) and the changed rows of those with one """
+    columns = (tuple(df.columns), spec, heartbeat)
+    if columns not in _deadbands:
+        measures = [RR_BY_CSV_CODE.get(col, {'code': col, 'csv_code': col}) for col in df.columns]
+        _deadbands[columns] = Deadband(measures, spec, heartbeat)
+    deadband = _deadbands[columns]
+    ticks = (df.index - pd.Timestamp(0)).total_seconds()
+    positions, rows = [], []
+    for pos, (tick, values) in enumerate(zip(ticks, df.values.tolist())):
+        row = deadband.filter(tick, values, key)
+        if row is not None:
+            positions.append(pos)
+            rows.append(row)
+    values = np.array(rows, dtype=np.float32).reshape(len(rows), len(deadband.sparse))
+    sparse = pd.DataFrame(values, index=df.index[positions], columns=df.columns[deadband.sparse])
+    return df.iloc[:, deadband.dense], sparse
+
+def append_frame(store, key, df, deadband=None, heartbeat=900.):
+    """ Append df to the table key, the measures with a deadband to <key>_deadband """
+    if deadband:
+        df, sparse = apply_deadband(df, deadband, heartbeat, key)
+        print("Deadband: keeping {} of {} rows of the measures with a deadband.".format(len(sparse), len(df)))
+        if len(sparse.columns):
+            store.append(key + '_deadband', sparse, format='t', complib='zlib', complevel=5)
+        if not len(df.columns):
+            return
+    store.append(key, df, format='t', complib=None)
+    #store.append('df', df, format='t', complib='zlib')
+    #store.append('df', df, format='t', complib='lzo', data_columns=True)
+    #store.append('df', df, format='t', complib=None, data_columns=True)
+
+def record_logfile(store, path, basename):
+    added_logfiles = {'path': [], 'basename': [], 'dt': []}
+    added_logfiles['path'].append(path)
+    added_logfiles['basename'].append(basename)
+    added_logfiles['dt'].append(dt.now())
+    logfiles = pd.DataFrame.from_dict(added_logfiles)
+    logfiles.set_index('dt', drop=True, inplace=True)
+    store.append('logfiles', logfiles, format='t', append=True, min_itemsize=200)
+
+def append_rows(store, df, by_serial=False, deadband=None, heartbeat=900.):
+    """ Append the rows of a log file to 'df' or, with by_serial, to the 'df_<serial>' table of each meter """
+    serials = df.pop('SN') if 'SN' in df.columns else None
+    if by_serial:
+        if serials is None:
+            raise ValueError('The log file has no SN column to append its rows by serial number.')
+        for serial, rows in df.groupby(serials.values, sort=False):
+            append_frame(store, 'df_' + serial, rows, deadband, heartbeat)
+        return
+    if serials is not None and serials.nunique() > 1:
+        raise ValueError('The log file holds the rows of several meters, please append it --by-serial.')
+    append_frame(store, 'df', df, deadband, heartbeat)
+
+def append_logfile(store, logfile, deadband=None, heartbeat=900., df=None, chunksize=None, by_serial=False):
+    print("Adding the logfile {} to the HDF5 file.".format(logfile))
+    if df is not None:
+        chunks = [df]
+    elif chunksize:
+        chunks = read_csv(logfile, chunksize, keep_serial=True)
+    else:
+        chunks = [read_csv(logfile, keep_serial=True)]
+    rows, start = 0, time.time()
+    for df in chunks:
+        rows += len(df)
+        append_rows(store, df, by_serial, deadband, heartbeat)
+        if chunksize:
+            print("  {} rows appended ({:.0f} rows/s)".format(rows, rows / max(time.time() - start, 1e-6)))
+    record_logfile(store, logfile, os.path.basename(logfile))
+
+def first_timestamp(logfile):
+    """ The timestamp of the first row of a CSV log file (or datetime.min if there is none) """
+    try:
+        with open(logfile, 'r') as f:
+            header = f.readline().rstrip('\n').split(';')
+            row = f.readline().rstrip('\n').split(';')
+        time_field = row[header.index('Time')]
+        return dt.strptime(row[header.index('Date')] + ' ' + time_field, csv_date_format(time_field))
+    except (IOError, ValueError, IndexError):
+        return dt.min
+
+def append_logfiles_parallel(store, logfiles, jobs, deadband=None, heartbeat=900., by_serial=False):
+    """ Parse the log files in jobs worker processes and append them in chronological order from this process """
+    from concurrent.futures import ProcessPoolExecutor
+    logfiles = iter(sorted(logfiles, key=first_timestamp))
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque((logfile, executor.submit(read_csv, logfile, None, True)) for logfile in itertools.islice(logfiles, 2 * jobs))
+        while pending:
+            logfile, future = pending.popleft()
+            df = future.result()
+            for logfile_next in itertools.islice(logfiles, 1):
+                pending.append((logfile_next, executor.submit(read_csv, logfile_next, None, True)))
+            append_logfile(store, logfile, deadband, heartbeat, df=df, by_serial=by_serial)
+            store.flush()
+
+def append_stream(store, chunks, path, basename, batch_rows=10000, deadband=None, heartbeat=900., by_serial=False):
+    """ Append a CSV log arriving in chunks of bytes in batches of batch_rows rows, yields the bytes and rows so far """
+    header, lines, carry = None, [], b''
+    received = rows = 0
+    def flush():
+        df = read_csv(io.BytesIO(header + b''.join(lines)), keep_serial=True)
+        append_rows(store, df, by_serial, deadband, heartbeat)
+        del lines[:]
+    for chunk in chunks:
+        if not chunk: continue # filter out keep-alive new chunks
+        received += len(chunk)
+        data = carry + chunk
+        end = data.rfind(b'\n') + 1
+        new_lines, carry = data[:end].splitlines(True), data[end:]
+        if header is None and new_lines:
+            header = new_lines.pop(0)
+        lines.extend(new_lines)
+        rows += len(new_lines)
+        if len(lines) >= batch_rows:
+            flush()
+        yield received, rows
+    if carry.strip():
+        lines.append(carry)
+        rows += 1
+    if lines:
+        flush()
+    record_logfile(store, path, basename)
+    yield received, rows
+
+def watch(store, log_folder, basenames, interval, deadband=None, heartbeat=900., chunksize=None, by_serial=False):
+    """ Ingest the closed log segments (not the .part ones) in directory as soon as they appear """
+    basenames = set(basenames)
+    failed = set()
+    print("Watching {} for new log files (every {} s), [Ctrl]-[c] to stop.".format(log_folder, interval))
+    try:
+        while True:
+            for logfile in sorted(glob.glob(log_folder)):
+                basename = os.path.basename(logfile)
+                if basename in basenames or basename in failed: continue
+                if basename.endswith(SEGMENT_PART): continue
+                try:
+                    append_logfile(store, logfile, deadband, heartbeat, chunksize=chunksize, by_serial=by_serial)
+                except Exception as e:
+                    sys.stderr.write("{} - couldn't ingest {}, skipping it. Error: {}\n".format(dt.now(), logfile, e))
+                    failed.add(basename)
+                    continue
+                finally:
+                    store.flush()
+                basenames.add(basename)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='Append data from a Gossen U180C/U189A CSV file to an HDF5 file on a daily basis')
     parser.add_argument('log_folder', help='The folder containing the log files')
     parser.add_argument('output_file', help='The data file to append to')
+    parser.add_argument('--watch', type=float, metavar='SECONDS', help='Keep running and ingest new log files (closed log segments) as they appear, checking every SECONDS.')
+    parser.add_argument('--deadband', metavar='SPEC', help="Store the measures with a deadband in the table df_deadband, only when they changed beyond it, e.g. '*kWh*=0.01,*kvarh*=0.01,F=0.02,V*=0.5%%'. Best used with a new HDF5 file.")
+    parser.add_argument('--heartbeat', type=float, default=900., help='With --deadband, store a full row at least every that many seconds [Default: 900].')
+    parser.add_argument('--by-serial', action='store_true', help="Append the rows of each meter to its own table 'df_<serial>' (needed for the fleet logs of U180C_log.py, which have an SN column).")
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes parsing the log files in parallel [Default: 1].')
+    parser.add_argument('--chunk-size', type=int, metavar='ROWS', help='Read and append the log files in chunks of that many rows to bound the memory usage [Default: whole files].')
     args = parser.parse_args()
+    if args.chunk_size and args.jobs > 1:
+        parser.error('--chunk-size cannot be combined with --jobs.')
 
     store = pd.HDFStore(args.output_file)
 
@@ -53,24 +248,21 @@ def main():
     files_to_check = glob.glob(args.log_folder)
     print("Checking {} file(s) to be appended:".format(len(files_to_check)))
     print('\n'.join(files_to_check) + '\n')
+    new_logfiles = []
     for logfile in files_to_check:
         if os.path.basename(logfile) not in basenames:
-            print("Adding the logfile {} to the HDF5 file.".format(logfile))
-            added_logfiles = {'path': [], 'basename': [], 'dt': []}
-            added_logfiles['path'].append(logfile)
-            added_logfiles['basename'].append(os.path.basename(logfile))
-            added_logfiles['dt'].append(dt.now())
-            df = read_csv(logfile)
-            store.append('df', df, format='t', complib=None)
-            #store.append('df', df, format='t', complib='zlib')
-            #store.append('df', df, format='t', complib='lzo', data_columns=True)
-            #store.append('df', df, format='t', complib=None, data_columns=True)
-            logfiles = pd.DataFrame.from_dict(added_logfiles)
-            logfiles.set_index('dt', drop=True, inplace=True)
-            store.append('logfiles', logfiles, format='t', append=True, min_itemsize=200)
+            if args.jobs > 1:
+                new_logfiles.append(logfile)
+            else:
+                append_logfile(store, logfile, args.deadband, args.heartbeat, chunksize=args.chunk_size, by_serial=args.by_serial)
+            basenames.append(os.path.basename(logfile))
         else:
             print("Logfile {} already contained in the HDF5 file.".format(logfile))
+    if new_logfiles:
+        append_logfiles_parallel(store, new_logfiles, args.jobs, args.deadband, args.heartbeat, args.by_serial)
     print()
+    if args.watch:
+        watch(store, args.log_folder, basenames, args.watch, args.deadband, args.heartbeat, args.chunk_size, args.by_serial)
     store.close()
 
     ## Calculate unique dates from the timestamp index column:
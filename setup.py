@@ -23,7 +23,7 @@ setup(name='u180c',
       url = 'https://github.com/pklaus/Gossen-U180C',
       license = 'GPL',
       #packages = ['',],
-      py_modules = ['u180c',],
+      py_modules = ['u180c', 'u180c_async',],
       entry_points = {
           'console_scripts': [
               #'u180c = u180c:main',
@@ -6,6 +6,18 @@ from datetime import datetime as dt
 import time
 import sys
 import struct
+import os
+import re
+import json
+import threading
+import fnmatch
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import itertools
+from array import array
+from collections import namedtuple
 
 
 # XML element name in
@@ -244,6 +256,9 @@ BALANCE_LIST = ['kWh∑', 'kVAh∑-L', 'kVAh∑-C', 'kvarh∑-L', 'kvarh∑-C']
 #RR_LIST = list(range(0, 167))
 RR_LIST = REAL_TIME_LIST + COUNTER_LIST_TOTAL + COUNTER_LIST_TARIFF1 + COUNTER_LIST_TARIFF2 + PARTIAL_COUNTER_LIST + BALANCE_LIST + ['at', 'psv']
 
+# All measures available as IEEE floats (that is: without 'at' and 'psv')
+ALL_MEASURES_LIST = REAL_TIME_LIST + COUNTER_LIST_TOTAL + COUNTER_LIST_TARIFF1 + COUNTER_LIST_TARIFF2 + PARTIAL_COUNTER_LIST + BALANCE_LIST
+
 
 COUNTER_COMMUNICATION_DATA_RAW = {
   'mapping' :
@@ -395,24 +410,279 @@ COILS_LIST = [
   'F', 'RES', 'RES', 'RES', 'RES', 'RES', 'RES', 'RES',
 ]
 
-def convert_registers(reg_dict):
-    ret_dict = dict()
+class RegisterDefinition(tuple):
+    """ Immutable register definition (see convert_registers()), also allowing item access like the former dicts """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def keys(self):
+        return self._fields
+
+def convert_registers(reg_dict, type_name='RegisterDef'):
     mapping = reg_dict['mapping']
+    fields = [mapping['key']] + [mapping[m] for m in sorted(m for m in mapping if type(m) == int)]
+    register_type = type(type_name, (RegisterDefinition, namedtuple(type_name, fields)), {'__slots__': ()})
+    ret_dict = dict()
     for key in reg_dict:
         if key == 'mapping': continue
         tpl = reg_dict[key] # tuple
-        register = dict()
-        for m in mapping:
-            if type(m) == int:
-                register[mapping[m]] = tpl[m]
-            elif m == 'key':
-                register[mapping[m]] = key
-        ret_dict[key] = register
-    return ret_dict
-
-RR = convert_registers(RR_RAW)
-COUNTER_COMMUNICATION_DATA = convert_registers(COUNTER_COMMUNICATION_DATA_RAW)
-COILS = convert_registers(COILS_RAW)
+        values = [key] + [tuple(val) if type(val) == list else val for val in tpl]
+        ret_dict[key] = register_type(*values)
+    return ret_dict, register_type
+
+RR, RegisterDef = convert_registers(RR_RAW, 'RegisterDef')
+COUNTER_COMMUNICATION_DATA, CounterCommunicationDef = convert_registers(COUNTER_COMMUNICATION_DATA_RAW, 'CounterCommunicationDef')
+COILS, CoilDef = convert_registers(COILS_RAW, 'CoilDef')
+
+# The Modbus protocol allows reading at most 125 registers with a single request
+MAX_READ_WORDS = 0x7D
+
+def plan_register_reads(register_list, kind='ieee', max_words=MAX_READ_WORDS, max_gap=0, registers=RR):
+    """ Coalesce the registers into as few reads as possible, returns a list of (start_address, num_words, [codes]) """
+    start_key, num_key = 'reg_' + kind + '_start_addr', 'reg_' + kind + '_num_words'
+    regs = sorted(set(register_list), key=lambda code: registers[code][start_key])
+    blocks = []
+    for code in regs:
+        rd = registers[code] # register definition
+        start, end = rd[start_key], rd[start_key] + rd[num_key]
+        if blocks:
+            block = blocks[-1]
+            block_end = block[0] + block[1]
+            if start - block_end <= max_gap and max(end, block_end) - block[0] <= max_words:
+                block[1] = max(end, block_end) - block[0]
+                block[2].append(code)
+                continue
+        assert end - start <= max_words
+        blocks.append([start, end - start, [code]])
+    return [tuple(block) for block in blocks]
+
+# The register definitions ordered by api_no and indexed by csv_code
+RR_BY_API_NO = tuple(RR[code] for code in RR_LIST)
+RR_BY_CSV_CODE = dict((rd.csv_code, rd) for rd in RR_BY_API_NO)
+
+# Lookup of the register code by code, csv_code or api_no
+RR_INDEX = dict()
+for rd in RR_BY_API_NO:
+    for key in (rd.code, rd.csv_code, rd.api_no):
+        RR_INDEX[key] = rd.code
+
+def find_register(measure):
+    """ Find the register definition for a code, csv_code or api_no. """
+    try:
+        return RR[RR_INDEX[measure]]
+    except KeyError:
+        raise U180CException('Measure {} is unknown.'.format(measure))
+
+class ReadPlan(object):
+    """ Precompiled read requests for a list of measures, pass it to .read_plan() on every poll cycle """
+
+    def __init__(self, measures, kind='ieee', max_words=MAX_READ_WORDS, max_gap=0):
+        self.registers = tuple(find_register(measure) for measure in measures)
+        self.codes = tuple(rd['code'] for rd in self.registers)
+        ieee_codes, int_codes = [], []
+        for rd in self.registers:
+            if kind == 'ieee' and rd['reg_ieee_start_addr'] is not None:
+                ieee_codes.append(rd['code'])
+            else:
+                int_codes.append(rd['code'])
+        positions = dict()
+        for pos, code in enumerate(self.codes):
+            positions.setdefault(code, []).append(pos)
+        # blocks: list of (start_address, num_words, BlockDecoder)
+        self.blocks = []
+        for reg_kind, codes in (('ieee', ieee_codes), ('int', int_codes)):
+            if not codes: continue
+            for start_address, num_words, block_codes in plan_register_reads(codes, reg_kind, max_words, max_gap):
+                fields = [(pos, RR[code], reg_kind) for code in block_codes for pos in positions[code]]
+                self.blocks.append((start_address, num_words, BlockDecoder(start_address, num_words, fields)))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def decode(self, block_registers, timestamp=None):
+        """ Decode the registers read for each block into a Reading aligned with .registers """
+        values = array('d', bytes(8 * len(self.codes)))
+        for block, registers in zip(self.blocks, block_registers):
+            block[2].decode(registers, values)
+        return Reading(timestamp or time.time(), values, self.registers)
+
+class Reading(object):
+    """ A timestamp and a flat array of values aligned to the register definitions of its ReadPlan """
+    __slots__ = ('timestamp', 'values', 'schema')
+
+    def __init__(self, timestamp, values, schema):
+        self.timestamp = timestamp
+        self.values = values
+        self.schema = schema
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, measure):
+        return self.values[self.schema.index(find_register(measure))]
+
+    def items(self):
+        """ (register definition, value) pairs like the lists returned by .all_measures """
+        return list(zip(self.schema, self.values))
+
+class BlockDecoder(object):
+    """ Decodes all values of a block of registers with a single precompiled struct format """
+
+    # struct format characters for the integer registers by number of words
+    INT_FORMATS = {1: 'H', 2: 'I', 3: 'HI'}
+
+    def __init__(self, start_address, num_words, fields):
+        """ fields: list of (position, register definition, 'ieee' or 'int') """
+        self.words = struct.Struct('>{}H'.format(num_words))
+        slots = dict()
+        for pos, rd, kind in fields:
+            slot = (rd['reg_' + kind + '_start_addr'] - start_address, rd['reg_' + kind + '_num_words'], kind)
+            slots.setdefault(slot, []).append((pos, rd))
+        fmt, cur, idx = '>', 0, 0
+        # conversions: list of (position, value index, low index or None, sign mask, divisor)
+        self.conversions = []
+        for slot in sorted(slots):
+            rel_addr, n_words, kind = slot
+            assert rel_addr >= cur, 'overlapping registers in one block'
+            fmt += 'x' * 2 * (rel_addr - cur)
+            cur = rel_addr + n_words
+            for pos, rd in slots[slot]:
+                if kind == 'ieee':
+                    self.conversions.append((pos, idx, None, 0, 1.))
+                else:
+                    sign_mask = 1 << (16 * n_words - 1) if rd['sign'] else 0
+                    low = idx + 1 if n_words == 3 else None
+                    self.conversions.append((pos, idx, low, sign_mask, rd['reg_int_divisor']))
+            fmt += 'f' if kind == 'ieee' else BlockDecoder.INT_FORMATS[n_words]
+            idx += 1 if kind == 'ieee' or n_words < 3 else 2
+        self.fields = struct.Struct(fmt)
+
+    def decode(self, registers, values):
+        raw = self.fields.unpack_from(self.words.pack(*registers))
+        for pos, idx, low, sign_mask, divisor in self.conversions:
+            value = raw[idx] if low is None else raw[idx] << 32 | raw[low]
+            if sign_mask and value & sign_mask:
+                value = -(value ^ sign_mask)
+            values[pos] = value / divisor
+
+_read_plans = dict()
+
+def get_read_plan(register_list, kind='ieee'):
+    """ Return a (cached) ReadPlan for the register_list """
+    key = (tuple(register_list), kind)
+    if key not in _read_plans:
+        _read_plans[key] = ReadPlan(register_list, kind)
+    return _read_plans[key]
+
+class TieredReadPlan(object):
+    """ Reads groups of measures at different intervals, forward-filling the last values of a group in between """
+
+    def __init__(self, measures, tiers):
+        self.registers = tuple(find_register(measure) for measure in measures)
+        self.codes = tuple(rd['code'] for rd in self.registers)
+        groups = [(set(find_register(m)['code'] for m in group), interval) for group, interval in tiers]
+        tier_codes = dict()
+        for code in self.codes:
+            interval = next((interval for group, interval in groups if code in group), 0.)
+            tier_codes.setdefault(interval, []).append(code)
+        # tiers: list of (interval, ReadPlan, positions in the output)
+        self.tiers = []
+        for interval in sorted(tier_codes):
+            codes = tier_codes[interval]
+            positions = [pos for pos, code in enumerate(self.codes) if code in codes]
+            self.tiers.append((interval, ReadPlan([self.codes[pos] for pos in positions]), positions))
+        self._state = dict()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def read(self, client):
+        """ Read the groups which are due from client and return a Reading with all values """
+        now = time.monotonic()
+        values, last_reads = self._state.setdefault(client, (array('d', bytes(8 * len(self.codes))), dict()))
+        timestamp = None
+        for interval, plan, positions in self.tiers:
+            last = last_reads.get(interval)
+            # allow for a little jitter of the poll loop
+            if last is not None and now - last < interval - min(0.1, interval / 10.):
+                continue
+            reading = client.read_plan(plan)
+            last_reads[interval] = now
+            timestamp = timestamp or reading.timestamp
+            for pos, value in zip(positions, reading.values):
+                values[pos] = value
+        return Reading(timestamp or time.time(), array('d', values), self.registers)
+
+def parse_deadband(spec, measures):
+    """ Parse a deadband spec like '*kWh*=0.01,V?=0.5%' into (absolute, relative) thresholds per measure, or None """
+    rules = []
+    for rule in spec.split(','):
+        pattern, sep, threshold = rule.rpartition('=')
+        try:
+            if threshold.endswith('%'):
+                rules.append((pattern, (0., float(threshold[:-1]) / 100.)))
+            else:
+                rules.append((pattern, (float(threshold), 0.)))
+        except ValueError:
+            raise U180CException('Invalid deadband {}, please state it as MEASURE=THRESHOLD[%].'.format(rule))
+        if not sep:
+            raise U180CException('Invalid deadband {}, please state it as MEASURE=THRESHOLD[%].'.format(rule))
+    thresholds = []
+    for m in measures:
+        names = (m['code'], m['csv_code'], m['csv_code'].replace(' ', ''))
+        thresholds.append(next((t for pattern, t in rules if any(fnmatch.fnmatchcase(name, pattern) for name in names)), None))
+    return thresholds
+
+class Deadband(object):
+    """ Change-based recording of the measures with a deadband (.sparse), all of them every heartbeat seconds """
+
+    def __init__(self, measures, spec, heartbeat=900.):
+        self.thresholds = parse_deadband(spec, measures)
+        self.heartbeat = heartbeat
+        # positions of the measures with (sparse) and without (dense) a deadband
+        self.sparse = [i for i, threshold in enumerate(self.thresholds) if threshold is not None]
+        self.dense = [i for i, threshold in enumerate(self.thresholds) if threshold is None]
+        self._state = dict()
+
+    def filter(self, tick, values, key=None):
+        """ The values of the .sparse measures to record for this row or None """
+        row = array('d', [values[i] for i in self.sparse])
+        state = self._state.get(key)
+        if state is None or tick - state[0] >= self.heartbeat:
+            self._state[key] = (tick, array('d', row))
+            return row
+        last = state[1]
+        changed = False
+        for j, i in enumerate(self.sparse):
+            x = row[j]
+            threshold = self.thresholds[i]
+            limit = max(threshold[0], threshold[1] * abs(last[j]))
+            # (a last value of NaN is replaced by the first valid value)
+            if x != x or abs(x - last[j]) <= limit:
+                row[j] = float('nan')
+                continue
+            last[j] = x
+            changed = True
+        return row if changed else None
+
+    def apply(self, tick, values, key=None):
+        """ .filter() for a single table: the full row with NaN for the unchanged values, None if there's nothing to record """
+        sparse = self.filter(tick, values, key)
+        if sparse is None and not self.dense: return None
+        row = array('d', values)
+        for j, i in enumerate(self.sparse):
+            row[i] = sparse[j] if sparse is not None else float('nan')
+        return row
 
 class U180CException(NameError):
     pass
@@ -423,97 +693,269 @@ class U180CAuthException(NameError):
 class U180CConnectionException(U180CException):
     pass
 
+# Modbus TCP framing (used by the clients that do not go through pymodbus)
+MODBUS_UNIT_ID = 0x00
+MODBUS_READ_COILS = 0x01
+MODBUS_READ_INPUT_REGISTERS = 0x04
+
+def modbus_tcp_request(transaction_id, function_code, address, count, unit=MODBUS_UNIT_ID):
+    """ Frame a Modbus TCP read request (MBAP header + PDU) """
+    return struct.pack('>HHHBBHH', transaction_id, 0, 6, unit, function_code, address, count)
+
+def modbus_tcp_header(header):
+    """ Returns (transaction_id, number of PDU bytes following) for a 7 byte MBAP header """
+    transaction_id, protocol_id, length, unit = struct.unpack('>HHHB', header)
+    if protocol_id != 0: raise U180CException('Invalid Modbus TCP response')
+    return transaction_id, length - 1
+
+def modbus_decode_pdu(pdu, count):
+    """ Decode the PDU of a read response into a list of registers or bits """
+    function_code = pdu[0]
+    if function_code >= 0x80:
+        raise U180CException('Error: returned function code is {} (exception code {})'.format(hex(function_code), pdu[1]))
+    data = pdu[2:2+pdu[1]]
+    if function_code == MODBUS_READ_INPUT_REGISTERS:
+        assert len(data) == 2 * count
+        return list(struct.unpack('>{}H'.format(count), data))
+    if function_code == MODBUS_READ_COILS:
+        return [bool(data[i // 8] >> (i % 8) & 0x1) for i in range(count)]
+    raise U180CException('Unexpected function code ' + hex(function_code))
+
+class ModbusTcpPipeline(object):
+    """ Modbus TCP transport keeping up to window read transactions in flight on one socket """
+
+    def __init__(self, host, port=502, window=4, timeout=5.):
+        self.host = host
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.transaction_id = 0
+        self.connect()
+
+    def connect(self):
+        import socket
+        self.close()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            raise U180CConnectionException('Cannot connect: {}'.format(e))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def receive(self, num_bytes):
+        while len(self.buffer) < num_bytes:
+            data = self.sock.recv(4096)
+            if not data: raise ConnectionError('Connection closed by the gateway')
+            self.buffer += data
+        data, self.buffer = self.buffer[:num_bytes], self.buffer[num_bytes:]
+        return data
+
+    def execute(self, transactions):
+        """ Execute (function_code, address, count) read transactions, returns the registers or bits of each """
+        results = [None] * len(transactions)
+        todo = list(range(len(transactions)))
+        while todo:
+            try:
+                self.run(transactions, todo, results)
+            except (OSError, ConnectionError) as e:
+                if self.window == 1: raise U180CConnectionException(str(e))
+                logging.warning('Pipelined Modbus requests failed ({}), falling back to one request at a time.'.format(e))
+                self.window = 1
+                self.connect()
+                todo = [i for i in todo if results[i] is None]
+        return results
+
+    def run(self, transactions, todo, results):
+        pending = dict()
+        pos = 0
+        while pos < len(todo) or pending:
+            requests = []
+            while pos < len(todo) and len(pending) < self.window:
+                self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+                pending[self.transaction_id] = todo[pos]
+                requests.append(modbus_tcp_request(self.transaction_id, *transactions[todo[pos]]))
+                pos += 1
+            if requests: self.sock.sendall(b''.join(requests))
+            transaction_id, pdu_len = modbus_tcp_header(self.receive(7))
+            pdu = self.receive(pdu_len)
+            if transaction_id not in pending: continue # stale response
+            i = pending.pop(transaction_id)
+            results[i] = modbus_decode_pdu(pdu, transactions[i][2])
+        del todo[:]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class DeviceCache(object):
+    """ A JSON file caching the device metadata by gateway host """
+
+    def __init__(self, path=None):
+        if path is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(cache_home, 'u180c', 'devices.json')
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def get(self, host):
+        return self.load().get(host)
+
+    def set(self, host, properties):
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # the lock file serializes the updates of concurrent processes (e.g. cron jobs)
+                with open(self.path + '.lock', 'a') as lock_file:
+                    if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    devices = self.load()
+                    devices[host] = properties
+                    tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(devices, f, indent=2, sort_keys=True)
+                    os.replace(tmp_path, self.path)
+            except OSError as e:
+                sys.stderr.write("Could not write the device cache {}: {}\n".format(self.path, e))
+
 class U180C(object):
 
-    def __init__(self, host, port=502):
+    # reserved words which may be read in between the counter communication data
+    CC_MAX_GAP = 4
+
+    def __init__(self, host, port=502, lazy=True, cache=None, window=1):
         self.host = host
         self.port = port
+        self.cache = cache
+        self.pipeline = None
         import pymodbus.client.sync
         import pymodbus.exceptions
         self.pymodbus = pymodbus
         try:
             self.client = self.pymodbus.client.sync.ModbusTcpClient(host, port=502)
             self.client.connect()
-            self.set_properties()
+            if cache is not None:
+                self.set_cached_properties()
+            else:
+                self.set_properties(lazy)
         except pymodbus.exceptions.ConnectionException:
             raise U180CConnectionException('Cannot connect')
+        if window > 1:
+            # keep several read requests in flight on a connection of its own and
+            # close the pymodbus one, which reconnects on demand (writes and the
+            # single register reads) instead of holding a second gateway slot
+            self.pipeline = ModbusTcpPipeline(host, port, window)
+            self.client.close()
+
+    def set_cached_properties(self):
+        """ Use the properties from the DeviceCache if the serial number read from the device matches """
+        cached = self.cache.get(self.host)
+        self.set_properties(lazy=True)
+        if cached and cached.get('serial') == self.serial:
+            self.properties = cached
+        else:
+            self.set_properties(lazy=False)
+            self.cache.set(self.host, self.properties)
 
-    def set_properties(self):
-        conf_vals = self.read_cc()
-        for conf, val in conf_vals:
-            if conf['code'] == 'serial':
-                self.serial = val
+    def set_properties(self, lazy=True):
+        """ Read the counter communication data, only the serial number if lazy """
+        codes = ['serial'] if lazy else COUNTER_COMMUNICATION_DATA_LIST
+        self.properties = dict((conf['code'], val) for conf, val in self.read_cc(codes))
+        self.serial = self.properties['serial']
 
-    def read_cc(self):
+    def read_cc(self, codes=COUNTER_COMMUNICATION_DATA_LIST):
+        """ Read the counter communication data of codes with as few requests as possible """
         ccd = COUNTER_COMMUNICATION_DATA
+        try:
+            blocks = [(start_address, self.read_input_block(start_address, num_words))
+                      for start_address, num_words, _ in plan_register_reads(codes, 'int', max_gap=self.CC_MAX_GAP, registers=ccd)]
+        except AssertionError:
+            # the device refused to read reserved registers, read them one by one
+            blocks = [(start_address, self.read_input_block(start_address, num_words))
+                      for start_address, num_words, _ in plan_register_reads(codes, 'int', registers=ccd)]
         ret_list = []
-        for code in COUNTER_COMMUNICATION_DATA_LIST:
+        for code in codes:
             rd = ccd[code] # register definition
-            rr = self.client.read_input_registers(rd['reg_int_start_addr'], rd['reg_int_num_words'])
-            assert rr.function_code < 0x80, 'Error: returned function code is ' + hex(rr.function_code)
-            if code == 'serial':
-                value = ''.join([''.join((chr(val>>8),chr(val&0xff))) for val in rr.registers])
-            elif code == 'model':
-                model_map = {0x03: '6A 3phases/4wires', 0x06: '6A 3phases/3wires',
-                             0x08: '80A 3phases/4wires', 0x0A: '80A 3phases/3wires',
-                             0x0C: '80A 1phase/2wires'}
-                assert rr.registers[0] in model_map
-                value = model_map[rr.registers[0]]
-            elif code == 'type':
-                type_map = {0x00: 'with RESET function, NO MID',
-                             0x01: 'NO MID',
-                             0x02: 'MID' }
-                assert rr.registers[0] in type_map
-                value = type_map[rr.registers[0]]
-            elif code in ['firmware', 'm_firmware']:
-                fw_str = str(rr.registers[0])
-                value = fw_str[:-2] + '.' + fw_str[-2:]
-            elif code in ['hardware', 'm_hardware']:
-                fw_str = str(rr.registers[0])
-                value = fw_str[:-2] + '.' + fw_str[-2:]
-            elif code == 'tariff':
-                tariff_map = {0x1: 'tariff 1', 0x2: 'tariff 2'}
-                value = tariff_map[rr.registers[0]]
-            elif code == 'pri_sec':
-                val_map = {0x0: 'primary', 0x1: 'secondary'}
-                value = val_map[rr.registers[0]]
-            elif code == 'error':
-                val_map = {0x0: 'none', 0x1: 'phase sequence error'}
-                value = val_map[rr.registers[0]]
-            elif code == 'fsa':
-                val_map = {0x0: '1A', 0x1: '5A', 0x2: '80A'}
-                value = val_map[rr.registers[0]]
-            elif code == 'wiring':
-                val_map = {0x1: '3phases/4-wires', 0x2: '3phases/3-wires', 0x3: '1-phase'}
-                value = val_map[rr.registers[0]]
-            elif code == 'partial':
-                bits = rr.registers[0]
-                partial_counter_map = [
-                  '+kWh∑ PAR',
-                  '-kWh∑ PAR',
-                  '+kVAh∑-L PAR',
-                  '-kVAh∑-L PAR',
-                  '+kVAh∑-C PAR',
-                  '-kVAh∑-C PAR',
-                  '+kvarh∑-L PAR',
-                  '-kvarh∑-L PAR',
-                  '+kvarh∑-C PAR',
-                  '-kvarh∑-C PAR',
-                ]
-                value = []
-                for partial_counter in partial_counter_map:
-                    value.append({partial_counter: bits & 0x1})
-                    bits = bits >> 1
-            elif code == 'm_serial':
-                value = ''.join([''.join((chr(val>>8),chr(val&0xff))) for val in rr.registers])
-            #elif code == 'svr':
-            #    val_map = {0x0: 'sign bit', 0x1: '2’s complement'}
-            #    value = val_map[rr.registers[0]]
-            else:
-                value = rr.registers
-            ret_list.append( (rd, value) )
+            start = rd['reg_int_start_addr']
+            for start_address, registers in blocks:
+                if start_address <= start < start_address + len(registers):
+                    rel_addr = start - start_address
+                    ret_list.append( (rd, U180C.decode_cc(code, registers[rel_addr:rel_addr+rd['reg_int_num_words']])) )
+                    break
         return ret_list
 
+    def decode_cc(code, registers):
+        """ Decode the value of a counter communication data register """
+        if code == 'serial':
+            value = ''.join([''.join((chr(val>>8),chr(val&0xff))) for val in registers])
+        elif code == 'model':
+            model_map = {0x03: '6A 3phases/4wires', 0x06: '6A 3phases/3wires',
+                         0x08: '80A 3phases/4wires', 0x0A: '80A 3phases/3wires',
+                         0x0C: '80A 1phase/2wires'}
+            assert registers[0] in model_map
+            value = model_map[registers[0]]
+        elif code == 'type':
+            type_map = {0x00: 'with RESET function, NO MID',
+                         0x01: 'NO MID',
+                         0x02: 'MID' }
+            assert registers[0] in type_map
+            value = type_map[registers[0]]
+        elif code in ['firmware', 'm_firmware']:
+            fw_str = str(registers[0])
+            value = fw_str[:-2] + '.' + fw_str[-2:]
+        elif code in ['hardware', 'm_hardware']:
+            fw_str = str(registers[0])
+            value = fw_str[:-2] + '.' + fw_str[-2:]
+        elif code == 'tariff':
+            tariff_map = {0x1: 'tariff 1', 0x2: 'tariff 2'}
+            value = tariff_map[registers[0]]
+        elif code == 'pri_sec':
+            val_map = {0x0: 'primary', 0x1: 'secondary'}
+            value = val_map[registers[0]]
+        elif code == 'error':
+            val_map = {0x0: 'none', 0x1: 'phase sequence error'}
+            value = val_map[registers[0]]
+        elif code == 'fsa':
+            val_map = {0x0: '1A', 0x1: '5A', 0x2: '80A'}
+            value = val_map[registers[0]]
+        elif code == 'wiring':
+            val_map = {0x1: '3phases/4-wires', 0x2: '3phases/3-wires', 0x3: '1-phase'}
+            value = val_map[registers[0]]
+        elif code == 'partial':
+            bits = registers[0]
+            partial_counter_map = [
+              '+kWh∑ PAR',
+              '-kWh∑ PAR',
+              '+kVAh∑-L PAR',
+              '-kVAh∑-L PAR',
+              '+kVAh∑-C PAR',
+              '-kVAh∑-C PAR',
+              '+kvarh∑-L PAR',
+              '-kvarh∑-L PAR',
+              '+kvarh∑-C PAR',
+              '-kvarh∑-C PAR',
+            ]
+            value = []
+            for partial_counter in partial_counter_map:
+                value.append({partial_counter: bits & 0x1})
+                bits = bits >> 1
+        elif code == 'm_serial':
+            value = ''.join([''.join((chr(val>>8),chr(val&0xff))) for val in registers])
+        #elif code == 'svr':
+        #    val_map = {0x0: 'sign bit', 0x1: '2’s complement'}
+        #    value = val_map[registers[0]]
+        else:
+            value = registers
+        return value
+
     @property
     def real_time_measures(self):
         return self.read_ieee_registers(REAL_TIME_LIST)
@@ -540,7 +982,7 @@ class U180C(object):
 
     @property
     def all_measures(self):
-        return self.real_time_measures + self.counters_total + self.counters_tariff1 + self.counters_tariff2 + self.counters_partial + self.counters_balance
+        return self.read_ieee_registers(ALL_MEASURES_LIST)
 
     def read_coherent_block(self, register_list):
         num_words = sum([RR[key]['reg_int_num_words'] for key in register_list])
@@ -556,39 +998,35 @@ class U180C(object):
             ret_list.append((reg, value))
         return ret_list
 
-    def read_ieee_registers(self, register_list):
-        min_address = min([RR[code]['reg_ieee_start_addr'] for code in register_list])
-        max_address = max([RR[code]['reg_ieee_start_addr']+RR[code]['reg_ieee_num_words'] for code in register_list])
-        num_words = max_address - min_address + 1
-        assert num_words <= 0xFF # manual says max 256 bytes, but might be 256 words = 512 bytes
-        rr = self.client.read_input_registers(min_address, num_words)
+    def read_input_block(self, start_address, num_words):
+        rr = self.client.read_input_registers(start_address, num_words)
         assert rr.function_code < 0x80
         assert len(rr.registers) == num_words
-        ret_list = []
-        for code in register_list:
-            rd = RR[code] # register definition
-            rel_addr = rd['reg_ieee_start_addr'] - min_address
-            words = rr.registers[rel_addr:rel_addr+rd['reg_ieee_num_words']]
-            ieee_bytes = bytes([words[0]>>8, words[0]&0xFF, words[1]>>8, words[1]&0xFF])
-            value = struct.unpack('>f', ieee_bytes)[0]
-            ret_list.append((rd, value))
-        return ret_list
+        return rr.registers
+
+    def read_plan(self, plan):
+        """ Execute a ReadPlan (or TieredReadPlan) and return a Reading """
+        if isinstance(plan, TieredReadPlan): return plan.read(self)
+        if self.pipeline:
+            transactions = [(MODBUS_READ_INPUT_REGISTERS, start_address, num_words) for start_address, num_words, _ in plan.blocks]
+            return plan.decode(self.pipeline.execute(transactions))
+        return plan.decode([self.read_input_block(start_address, num_words) for start_address, num_words, _ in plan.blocks])
+
+    def poll(self, plan):
+        """ Read a ReadPlan and the coils (in a single round trip if pipelined), returns (Reading, coils) """
+        if not self.pipeline or isinstance(plan, TieredReadPlan):
+            return self.read_plan(plan), self.read_coils()
+        transactions = [(MODBUS_READ_COILS, 0x00, len(COILS_LIST))]
+        transactions += [(MODBUS_READ_INPUT_REGISTERS, start_address, num_words) for start_address, num_words, _ in plan.blocks]
+        results = self.pipeline.execute(transactions)
+        self.coils = U180C.decode_coils(results[0])
+        return plan.decode(results[1:]), self.coils
+
+    def read_ieee_registers(self, register_list):
+        return self.read_plan(get_read_plan(register_list, 'ieee')).items()
 
     def read_int_registers(self, register_list):
-        min_address = min([RR[code]['reg_int_start_addr'] for code in register_list])
-        max_address = max([RR[code]['reg_int_start_addr']+RR[code]['reg_int_num_words'] for code in register_list])
-        num_words = max_address - min_address + 1
-        assert num_words <= 0xFF # manual says max 256 bytes, but might be 256 words = 512 bytes
-        rr = self.client.read_input_registers(min_address, num_words)
-        assert rr.function_code < 0x80
-        assert len(rr.registers) == num_words
-        ret_list = []
-        for code in register_list:
-            rd = RR[code] # register definition
-            rel_addr = rd['reg_int_start_addr'] - min_address
-            value = U180C.calculate_value_int_reg(rd, rr.registers[rel_addr:rel_addr+rd['reg_int_num_words']])
-            ret_list.append((rd, value))
-        return ret_list
+        return self.read_plan(get_read_plan(register_list, 'int')).items()
 
     def reset_counters(self, which='all counters'):
         """ Will work only if your counter is resettable! """
@@ -670,16 +1108,22 @@ class U180C(object):
     def read_coils(self):
         coil_addr = 0x00
         num_coils = len(COILS_LIST)
+        if self.pipeline:
+            self.coils = U180C.decode_coils(self.pipeline.execute([(MODBUS_READ_COILS, coil_addr, num_coils)])[0])
+            return self.coils
         rr = self.client.read_coils(coil_addr, num_coils)
         assert rr.function_code < 0x80
         assert len(rr.bits) == num_coils
-        self.coils = []
+        self.coils = U180C.decode_coils(rr.bits)
+        return self.coils
+
+    def decode_coils(bits):
+        coils = []
         pos = 0
         for key in COILS_LIST:
-            self.coils.append((COILS[key], rr.bits[pos]))
+            coils.append((COILS[key], bits[pos]))
             pos += 1
-        self.coils = [coil for coil in self.coils if coil[0]['code'] != 'RES']
-        return self.coils
+        return [coil for coil in coils if coil[0]['code'] != 'RES']
 
     def read_register(self, code):
         reg = RR[code]
@@ -701,112 +1145,282 @@ class U180C(object):
             print("{code} ({descr}) - unit: {unit}".format(**rd))
 
     def close(self):
+        if self.pipeline: self.pipeline.close()
         self.client.close()
 try:
     clock = time.perf_counter
 except AttributeError:
     clock = time.time
 
+def parse_readings(xml_text):
+    """ Parse a *_readings.xml in a single pass, returns (sn, datet, paracnt, values by api_no with NaN if missing) """
+    import xml.parsers.expat
+    fields = {'sn': None, 'datet': None, 'paracnt': None}
+    values = array('d', [float('nan')]) * len(RR_BY_API_NO)
+    text = []
+    def start_element(name, attrs):
+        del text[:]
+    def end_element(name):
+        if name.startswith('param'):
+            try:
+                api_no, value = int(name[5:]), float(''.join(text))
+            except ValueError:
+                # an empty or non-numeric value stays NaN
+                return
+            if 0 <= api_no < len(values): values[api_no] = value
+        elif name in fields:
+            fields[name] = ''.join(text).strip()
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = text.append
+    parser.Parse(xml_text, True)
+    return fields['sn'], fields['datet'], int(fields['paracnt']), values
+
+# The suffix of a log segment still being written (see U180C_log.py --segment-dir)
+SEGMENT_PART = '.part'
+
+class CsvArchive(object):
+    """ The local archive <directory>/<serial>.csv of the device log, for incremental downloads """
+
+    def __init__(self, directory, serial):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, '{}.csv'.format(serial))
+        self.state_path = self.path + '.state'
+        self.state = {'offset': 0, 'size': 0, 'tail': '', 'last': None, 'header': None}
+        if os.path.exists(self.path):
+            try:
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    self.state.update(json.load(f))
+            except (IOError, ValueError):
+                raise U180CException('The state {} of the archive is missing, please start a new archive.'.format(self.state_path))
+
+    @property
+    def tail(self):
+        return self.state['tail'].encode('latin-1')
+
+    def range_start(self):
+        """ Where to resume the download: including the last line to make sure it's the same log """
+        return self.state['offset'] - len(self.tail)
+
+    def timestamp(self, line):
+        """ The timestamp of a row of the log, None if it can't be parsed """
+        fields = line.rstrip(b'\r\n').split(b';')
+        header = self.state['header'].split(';')
+        try:
+            date, time = fields[header.index('Date')], fields[header.index('Time')]
+            return dt.strptime((date + b' ' + time).decode('ascii'), '%d/%m/%Y %H:%M:%S')
+        except (IndexError, ValueError):
+            return None
+
+    def save_state(self):
+        tmp_path = '{}.{}.tmp'.format(self.state_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def append(self, chunks, base=0, with_header=True):
+        """ Append the complete rows in chunks newer than the last archived one, yields the bytes received so far """
+        state = self.state
+        skip_header = with_header
+        last = dt.strptime(state['last'], '%Y-%m-%dT%H:%M:%S') if state['last'] and with_header else None
+        received, carry = 0, b''
+        with open(self.path, 'ab') as f:
+            f.truncate(state['size'])
+            try:
+                for chunk in chunks:
+                    if not chunk: continue # filter out keep-alive new chunks
+                    received += len(chunk)
+                    yield received
+                    data = carry + chunk
+                    end = data.rfind(b'\n') + 1
+                    lines, carry = data[:end], data[end:]
+                    if not lines: continue
+                    # the last line received, to check the log when resuming
+                    state['tail'] = lines[:-1].rsplit(b'\n', 1)[-1].decode('latin-1') + '\n'
+                    if skip_header:
+                        header_line, lines = lines.split(b'\n', 1)
+                        header = header_line.rstrip(b'\r').decode('latin-1')
+                        if state['header'] is None:
+                            state['header'] = header
+                            f.write(header_line + b'\n')
+                        elif header != state['header']:
+                            raise U180CException('The columns of the device log changed, please start a new archive.')
+                        skip_header = False
+                    rows = []
+                    for row in lines.splitlines(True):
+                        if not row.strip(): continue
+                        timestamp = self.timestamp(row)
+                        if timestamp is None:
+                            sys.stderr.write("{} - skipping an unreadable row of the device log: {!r}\n".format(dt.now(), row))
+                            continue
+                        # skip the rows archived before (the log is in chronological order)
+                        if last is not None and timestamp <= last: continue
+                        last = None
+                        rows.append(row)
+                        state['last'] = timestamp.isoformat()
+                    f.write(b''.join(rows))
+                    state['offset'] = base + received - len(carry)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+                state['size'] = f.tell()
+                self.save_state()
+
 class U180CWeb(object):
 
     MIN_INTERVAL = 5.
     RETRIES = 3
+    BACKOFF = 0.3 # seconds, doubled with every retry
+    TIMEOUT = (3.05, 10.) # connect and read timeout in seconds
 
-    def __init__(self, host):
+    def __init__(self, host, cache=None):
         assert host.startswith('http')
         self.host = host
+        self.cache = cache
         self.last = clock() - 100000
-        self._cookies = None
         import requests
         import xml.dom.minidom
         self.requests = requests
         self.minidom = xml.dom.minidom
+        self.session = self.create_session()
+        # the last readings buffer address and the validators for conditional requests
+        self._addr = None
+        self._validators = dict()
+        self._datet = None
         self.authenticated = False
-        self.update_values(set_serial = True)
+        self._serial_validated = False
+        cached = cache.get(host) if cache is not None else None
+        if cached:
+            # validated against the serial number of the next readings, so
+            # the cache only defers this fetch; validate_serial() does it
+            # before any action on the device log (no saving for those)
+            self.serial = cached['serial']
+        else:
+            self.update_values(set_serial = True)
 
     def update_values(self, set_serial=False):
-        if clock() - self.last < self.MIN_INTERVAL: return
+        """ Fetch the current readings (at most every MIN_INTERVAL seconds), returns False on failure """
+        if clock() - self.last < self.MIN_INTERVAL: return True
         self.last = clock()
-        tries = self.RETRIES
-        dom = None
-        while tries:
-            tries -= 1
-            try:
-                r = self.http_get('{host}/tmp/index.readings.xml?{timestamp}'.format(host=self.host, timestamp=int(time.time())))
-                dom = self.minidom.parseString(r.text)
-                addr = dom.getElementsByTagName('readings')[0].firstChild.nodeValue
-                r = self.http_get('{host}/tmp/{addr}_readings.xml?{timestamp}'.format(host=self.host, addr=addr, timestamp=int(time.time())))
-                dom = self.minidom.parseString(r.text)
-                break
-            except Exception as e:
-                sys.stderr.write("{} - couldn't get readings. Error: {}\n".format(dt.now(), e))
-        if dom is None:
+        # retries with backoff are handled by the session
+        try:
+            r = self.http_get('{host}/tmp/index.readings.xml?{timestamp}'.format(host=self.host, timestamp=int(time.time())))
+            dom = self.minidom.parseString(r.text)
+            addr = dom.getElementsByTagName('readings')[0].firstChild.nodeValue
+            r, content = self.fetch_readings(addr)
+            if content is None:
+                return True
+            sn, datet, paracnt, values = parse_readings(content)
+        except Exception as e:
+            sys.stderr.write("{} - couldn't get readings. Error: {}\n".format(dt.now(), e))
             return False
-        root = dom.firstChild
-        if set_serial:
-            self.serial = root.getElementsByTagName('sn')[0].firstChild.nodeValue
-        datet = root.getElementsByTagName('datet')[0].firstChild.nodeValue
+        self._addr = addr
+        self._validators = dict()
+        if r.headers.get('ETag'): self._validators['If-None-Match'] = r.headers['ETag']
+        if r.headers.get('Last-Modified'): self._validators['If-Modified-Since'] = r.headers['Last-Modified']
+        if set_serial or sn != getattr(self, 'serial', sn):
+            self.serial = sn
+            if self.cache is not None: self.cache.set(self.host, {'serial': sn})
+        self._serial_validated = True
+        self._datet = datet
         da, ti = datet.split()
         da = da.split('/')
         ti = ti.split(':')
         datet = [int(el) for el in reversed(da)] + [int(el) for el in ti]
-        datet = dt(*datet)
-        #import pdb; pdb.set_trace()
-        paracnt = root.getElementsByTagName('paracnt')[0].firstChild.nodeValue
-        sn = root.getElementsByTagName('sn')[0].firstChild.nodeValue
-        assert int(paracnt) == 167
-        ret_list = []
-        for key in RR_LIST:
-            rd = RR[key].copy()
-            val = root.getElementsByTagName('param'+str(rd['api_no']))[0].firstChild.nodeValue
-            ret_list.append((rd, val))
-        self._values = ret_list
+        self.datet = dt(*datet)
+        assert paracnt == 167
+        self._timestamp = time.time()
+        self._values = values
         return True
 
+    def fetch_readings(self, addr):
+        """ Download the readings buffer addr, returns (response, None) for an unchanged snapshot (304, or the same <datet>) """
+        url = '{host}/tmp/{addr}_readings.xml?{timestamp}'.format(host=self.host, addr=addr, timestamp=int(time.time()))
+        if addr != self._addr:
+            r = self.http_get(url)
+            r.raise_for_status()
+            return r, r.content
+        if self._validators:
+            r = self.http_get(url, headers=self._validators)
+            if r.status_code == 304: return r, None
+            r.raise_for_status()
+            return r, r.content
+        r = self.http_get(url, stream=True)
+        try:
+            r.raise_for_status()
+            chunks = r.iter_content(1024)
+            content = b''
+            for chunk in chunks:
+                content += chunk
+                match = re.search(br'<datet>([^<]*)</datet>', content)
+                if match:
+                    # closing the response (below) drops the rest of an unchanged snapshot
+                    if match.group(1).strip().decode() == self._datet: return r, None
+                    break
+            return r, content + b''.join(chunks)
+        finally:
+            r.close()
+
+    def read_plan(self, plan):
+        """ Return a Reading with the values of the ReadPlan (or TieredReadPlan) """
+        if isinstance(plan, TieredReadPlan): return plan.read(self)
+        if not self.update_values():
+            raise U180CConnectionException("Couldn't get the readings from {}.".format(self.host))
+        return Reading(self._timestamp, array('d', [self._values[rd.api_no] for rd in plan.registers]), plan.registers)
+
+    def read_list(self, register_list):
+        return self.read_plan(get_read_plan(register_list)).items()
+
     @property
     def counters_total(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in COUNTER_LIST_TOTAL]
+        return self.read_list(COUNTER_LIST_TOTAL)
 
     @property
     def counters_balance(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in BALANCE_LIST]
+        return self.read_list(BALANCE_LIST)
 
     @property
     def counters_tariff1(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in COUNTER_LIST_TARIFF1]
+        return self.read_list(COUNTER_LIST_TARIFF1)
 
     @property
     def counters_tariff2(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in COUNTER_LIST_TARIFF2]
+        return self.read_list(COUNTER_LIST_TARIFF2)
 
     @property
     def counters_partial(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in PARTIAL_COUNTER_LIST]
+        return self.read_list(PARTIAL_COUNTER_LIST)
 
     @property
     def all_measures(self):
-        self.update_values()
-        return self._values
+        return self.read_list(RR_LIST)
 
     @property
     def real_time_measures(self):
-        self.update_values()
-        return [val for val in self._values if val[0]['code'] in REAL_TIME_LIST]
+        return self.read_list(REAL_TIME_LIST)
+
+    def create_session(self):
+        """ A keep-alive requests session retrying failed idempotent requests with exponential backoff """
+        from requests.adapters import HTTPAdapter
+        try:
+            from urllib3.util.retry import Retry
+        except ImportError:
+            from requests.packages.urllib3.util.retry import Retry
+        retry = Retry(total=self.RETRIES, backoff_factor=self.BACKOFF, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        session = self.requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def http_post(self, *args, **kwargs):
-        if self._cookies:
-            kwargs['cookies'] = self._cookies
-        return self.requests.post(*args, **kwargs)
+        kwargs.setdefault('timeout', self.TIMEOUT)
+        return self.session.post(*args, **kwargs)
 
     def http_get(self, *args, **kwargs):
-        if self._cookies:
-            kwargs['cookies'] = self._cookies
-        return self.requests.get(*args, **kwargs)
+        kwargs.setdefault('timeout', self.TIMEOUT)
+        return self.session.get(*args, **kwargs)
 
     def logout(self):
         r = self.http_get('{host}/cgi-bin/index'.format(host=self.host))
@@ -834,8 +1448,8 @@ class U180CWeb(object):
         }
         r = self.http_post('{host}/cgi-bin/index'.format(host=self.host), data=data)
         if 'Logout' in r.text:
+            # the session keeps the login cookie from now on
             self.authenticated = True
-            self._cookies = r.cookies
             return True
         else:
             return False
@@ -856,6 +1470,7 @@ class U180CWeb(object):
 
     def close(self):
         self.logout()
+        self.session.close()
 
     def read_state(self):
         if not self.authenticated: raise U180CAuthException('Need to authenticate before calling this function')
@@ -864,23 +1479,81 @@ class U180CWeb(object):
         dom = self.minidom.parseString(r.text)
         root = dom.firstChild
 
-    def download_csv(self):
+    def validate_serial(self):
+        """ Check the (possibly cached) serial number by fetching the readings, before acting on the device log """
+        if self._serial_validated: return
+        self.last = clock() - self.MIN_INTERVAL
+        self._addr = None
+        if not self.update_values():
+            raise U180CConnectionException("Couldn't check the serial number of {}.".format(self.host))
+
+    def storage_url(self, action):
+        self.validate_serial()
+        return '{host}/cgi-bin/storage?action={action}&id={serial}'.format(host=self.host, action=action, serial=self.serial)
+
+    def csv_url(self):
+        return self.storage_url('download')
+
+    def csv_filename(self):
+        """ A timestamped file name for a download of the device log """
+        self.validate_serial()
         dt_str = dt.now().replace(microsecond=0).isoformat(sep='_').replace(':', '-')
-        local_filename = '{serial}_{dt_str}.csv'.format(serial=self.serial, dt_str=dt_str)
-        url = '{host}/cgi-bin/storage?action=download&id={serial}'.format(host=self.host, serial=self.serial)
-        r = self.http_post(url, stream=True, cookies=self._cookies)
+        return '{serial}_{dt_str}.csv'.format(serial=self.serial, dt_str=dt_str)
+
+    def stream_csv(self, chunk_size=1024*64):
+        """ The device log as an iterator over chunks of bytes (as they arrive) """
+        r = self.http_post(self.csv_url(), stream=True)
+        return r.iter_content(chunk_size=chunk_size)
+
+    def download_csv(self, incremental=False, directory='.'):
+        """ Download the device log (with incremental its new rows only, see CsvArchive), yields the filename, then the bytes so far """
+        if incremental:
+            for status in self.download_csv_incremental(self.csv_url(), directory):
+                yield status
+            return
+        local_filename = self.csv_filename()
         total_len = 0
         yield local_filename
         with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024*64):
+            for chunk in self.stream_csv():
                 if chunk: # filter out keep-alive new chunks
                     total_len += len(chunk)
                     yield total_len
                     f.write(chunk)
                     f.flush()
 
+    def download_csv_incremental(self, url, directory='.'):
+        archive = CsvArchive(directory, self.serial)
+        yield archive.path
+        start = archive.range_start()
+        r = None
+        if start > 0:
+            # Fetch the new tail only (if the gateway supports HTTP Range requests),
+            # starting with the last archived line to be sure the log wasn't cleared.
+            r = self.http_post(url, stream=True, headers={'Range': 'bytes={}-'.format(start)})
+            if r.status_code == 206:
+                chunks = r.iter_content(chunk_size=1024*64)
+                tail, overlap = archive.tail, b''
+                for chunk in chunks:
+                    overlap += chunk
+                    if len(overlap) >= len(tail): break
+                if overlap[:len(tail)] == tail:
+                    rest = itertools.chain([overlap[len(tail):]], chunks)
+                    for received in archive.append(rest, archive.state['offset'], with_header=False):
+                        yield received + len(tail)
+                    return
+                logging.info('The device log changed, downloading it completely.')
+            if r.status_code != 200:
+                r.close()
+                r = None
+        # The complete log, skipping the rows archived before
+        if r is None:
+            r = self.http_post(url, stream=True)
+        for received in archive.append(r.iter_content(chunk_size=1024*64)):
+            yield received
+
     def clear_csv(self):
-        url = '{host}/cgi-bin/storage?action=clear&id={serial}'.format(host=self.host, serial=self.serial)
+        url = self.storage_url('clear')
         r = self.http_get(url)
 
     def enable_logging(self):
@@ -890,17 +1563,89 @@ class U180CWeb(object):
         self.set_logging(False)
 
     def set_logging(self, on=True):
-        url = '{host}/cgi-bin/storage?action=enable&id={serial}'.format(host=self.host, serial=self.serial)
+        url = self.storage_url('enable')
         if on:
             r = self.http_post(url, data = {'selected': 'on'})
         else:
             r = self.http_post(url)
 
 
-def U180CFactory(connection_string):
+def U180CFactory(connection_string, cache=None, window=1):
     cs = connection_string
     if cs.startswith('http://'):
-        return U180CWeb(cs)
+        return U180CWeb(cs, cache=cache)
     else:
-        return U180C(cs)
+        return U180C(cs, cache=cache, window=window)
+
+class U180CFleet(object):
+    """ Gateways (see U180CFactory) polled concurrently by a thread pool """
+
+    def __init__(self, connection_strings, timeout=10., cache=None, window=1):
+        from concurrent.futures import ThreadPoolExecutor
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=len(connection_strings))
+        # gateway -> future of its call still running after a timeout
+        self._in_flight = dict()
+        futures = [(cs, self.executor.submit(U180CFactory, cs, cache=cache, window=window)) for cs in connection_strings]
+        self.gateways = []
+        for cs, future in futures:
+            try:
+                self.gateways.append(future.result())
+            except Exception as e:
+                sys.stderr.write("{} - couldn't connect to {}, leaving it out. Error: {}\n".format(dt.now(), cs, e))
+        if not self.gateways:
+            self.executor.shutdown()
+            raise U180CConnectionException('Could not connect to any of the gateways.')
+
+    def map(self, func, *args):
+        """ Call func(gateway, *args) on all gateways in parallel, returns a list of (gateway, result or exception) """
+        from concurrent.futures import wait
+        futures = []
+        for gateway in self.gateways:
+            pending = self._in_flight.get(gateway)
+            if pending is not None and not pending.done():
+                futures.append(None)
+                continue
+            self._in_flight.pop(gateway, None)
+            futures.append(self.executor.submit(func, gateway, *args))
+        wait([future for future in futures if future is not None], self.timeout)
+        results = []
+        for gateway, future in zip(self.gateways, futures):
+            if future is None:
+                results.append((gateway, U180CConnectionException('still busy with an earlier request')))
+            elif not future.done():
+                self._in_flight[gateway] = future
+                results.append((gateway, U180CConnectionException('no answer within {} s'.format(self.timeout))))
+            elif future.exception() is not None:
+                results.append((gateway, future.exception()))
+            else:
+                results.append((gateway, future.result()))
+        return results
+
+    def authenticate(self, username='admin', password='admin'):
+        web_gateways = [gateway for gateway in self.gateways if type(gateway) is U180CWeb]
+        return all(gateway.authenticate(username, password) for gateway in web_gateways)
+
+    def read_coils(self):
+        """ Returns a list of (serial, coils) """
+        return [(gateway.serial, coils) for gateway, coils in self.map(lambda gateway: gateway.read_coils())]
+
+    def read_plan(self, plan, timestamp=None):
+        """ Read the ReadPlan from all gateways, returns a list of (serial, Reading) of those answering """
+        timestamp = timestamp or time.time()
+        ret_list = []
+        for gateway, reading in self.map(lambda gateway: gateway.read_plan(plan)):
+            if isinstance(reading, Exception):
+                sys.stderr.write("{} - couldn't read from {}. Error: {}\n".format(dt.now(), gateway.host, reading))
+                continue
+            reading.timestamp = timestamp
+            ret_list.append((gateway.serial, reading))
+        return ret_list
+
+    def close(self):
+        for gateway in self.gateways:
+            pending = self._in_flight.get(gateway)
+            if pending is None or pending.done():
+                gateway.close()
+        self.executor.shutdown(wait=False)
 
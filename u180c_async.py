@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+""" asyncio clients for polling many U180C gateways concurrently from a single event loop """
+
+import asyncio
+import functools
+
+from u180c import *
+
+class AsyncU180C(object):
+    """ Modbus TCP client talking to the U180C with asyncio streams """
+
+    def __init__(self, host, port=502, timeout=5.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.serial = None
+        self._transaction_id = 0
+        self._lock = None
+        self._reader = self._writer = None
+
+    async def open(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            raise U180CConnectionException('Cannot connect')
+
+    async def connect(self):
+        self._lock = asyncio.Lock()
+        await self.open()
+        await self.set_properties()
+        return self
+
+    async def set_properties(self):
+        rd = COUNTER_COMMUNICATION_DATA['serial']
+        registers = await self.read_input_block(rd['reg_int_start_addr'], rd['reg_int_num_words'])
+        self.serial = U180C.decode_cc('serial', registers)
+
+    async def transaction(self, function_code, address, count):
+        async with self._lock:
+            if self._writer is None:
+                await self.open()
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            try:
+                self._writer.write(modbus_tcp_request(self._transaction_id, function_code, address, count))
+                await self._writer.drain()
+                header = await asyncio.wait_for(self._reader.readexactly(7), self.timeout)
+                transaction_id, pdu_len = modbus_tcp_header(header)
+                pdu = await asyncio.wait_for(self._reader.readexactly(pdu_len), self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, asyncio.CancelledError):
+                # the stream is out of sync now, reconnect with the next transaction
+                self._writer.close()
+                self._writer = None
+                raise
+        if transaction_id != self._transaction_id:
+            raise U180CException('Unexpected Modbus transaction id {}'.format(transaction_id))
+        return modbus_decode_pdu(pdu, count)
+
+    async def read_input_block(self, start_address, num_words):
+        return await self.transaction(MODBUS_READ_INPUT_REGISTERS, start_address, num_words)
+
+    async def read_plan(self, plan):
+        """ Execute a ReadPlan and return a Reading """
+        block_registers = []
+        for start_address, num_words, _ in plan.blocks:
+            block_registers.append(await self.read_input_block(start_address, num_words))
+        return plan.decode(block_registers)
+
+    async def read_list(self, register_list):
+        return (await self.read_plan(get_read_plan(register_list))).items()
+
+    async def real_time_measures(self):
+        return await self.read_list(REAL_TIME_LIST)
+
+    async def counters_total(self):
+        return await self.read_list(COUNTER_LIST_TOTAL)
+
+    async def counters_tariff1(self):
+        return await self.read_list(COUNTER_LIST_TARIFF1)
+
+    async def counters_tariff2(self):
+        return await self.read_list(COUNTER_LIST_TARIFF2)
+
+    async def counters_partial(self):
+        return await self.read_list(PARTIAL_COUNTER_LIST)
+
+    async def counters_balance(self):
+        return await self.read_list(BALANCE_LIST)
+
+    async def all_measures(self):
+        return await self.read_list(ALL_MEASURES_LIST)
+
+    async def read_coils(self):
+        bits = await self.transaction(MODBUS_READ_COILS, 0x00, len(COILS_LIST))
+        self.coils = U180C.decode_coils(bits)
+        return self.coils
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+class AsyncU180CWeb(object):
+    """ HTTP client with the API of AsyncU180C, running the blocking U180CWeb in a thread of its own """
+
+    def __init__(self, host, executor=None):
+        assert host.startswith('http')
+        self.host = host
+        self.own_executor = executor is None
+        if self.own_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=1)
+        self.executor = executor
+        self.serial = None
+        self.web = None
+        self._pending = None
+
+    async def run(self, func, *args, **kwargs):
+        if self._pending is not None and not self._pending.done():
+            raise U180CConnectionException('{} is still busy with an earlier request'.format(self.host))
+        self._pending = self.executor.submit(functools.partial(func, *args, **kwargs))
+        return await asyncio.wrap_future(self._pending)
+
+    async def connect(self):
+        self.web = await self.run(U180CWeb, self.host)
+        self.serial = self.web.serial
+        return self
+
+    async def authenticate(self, username='admin', password='admin'):
+        return await self.run(self.web.authenticate, username, password)
+
+    async def read_plan(self, plan):
+        """ Return a Reading with the values of the ReadPlan """
+        return await self.run(self.web.read_plan, plan)
+
+    async def read_list(self, register_list):
+        return await self.run(self.web.read_list, register_list)
+
+    async def real_time_measures(self):
+        return await self.read_list(REAL_TIME_LIST)
+
+    async def counters_total(self):
+        return await self.read_list(COUNTER_LIST_TOTAL)
+
+    async def counters_tariff1(self):
+        return await self.read_list(COUNTER_LIST_TARIFF1)
+
+    async def counters_tariff2(self):
+        return await self.read_list(COUNTER_LIST_TARIFF2)
+
+    async def counters_partial(self):
+        return await self.read_list(PARTIAL_COUNTER_LIST)
+
+    async def counters_balance(self):
+        return await self.read_list(BALANCE_LIST)
+
+    async def all_measures(self):
+        return await self.read_list(RR_LIST)
+
+    async def read_coils(self):
+        return await self.run(self.web.read_coils)
+
+    async def close(self):
+        if self.web:
+            if self._pending is None or self._pending.done():
+                await self.run(self.web.close)
+            self.web = None
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+def AsyncU180CFactory(connection_string):
+    cs = connection_string
+    if cs.startswith('http://'):
+        return AsyncU180CWeb(cs)
+    else:
+        return AsyncU180C(cs)
+
+async def poll_gateways(clients, plan, timeout=5.):
+    """ Read the ReadPlan from all clients in parallel, returns a Reading (or the exception raised) for each """
+    tasks = [asyncio.wait_for(client.read_plan(plan), timeout) for client in clients]
+    return await asyncio.gather(*tasks, return_exceptions=True)